@@ -31,7 +31,7 @@ setup(name=NAME,
       long_description=LONG_DESC,
       license=LICENSE,
       keywords=KEYWORDS,
-      packages=["withhacks","withhacks.tests"],
+      packages=["withhacks","withhacks.tests","withhacks.benchmarks"],
       install_requires=['bytecode'],
       test_suite='withhacks.tests'
      )
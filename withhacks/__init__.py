@@ -29,6 +29,26 @@ hacks:
                of a given object (like "with" in JavaScript or VB)
   :keyspace:   direct all variable accesses and assignments to the keys of
                of a given object (like namespace() but for dicts)
+  :run_in:     run the body of the with-statement in the background, using
+               a thread or process pool executor
+  :parallel_map:  apply the body of the with-statement to each item of an
+                  iterable, using a thread or process pool
+
+If you'd rather not pay for the hackery at runtime, install_import_hook()
+can rewrite these prebuilt hacks into equivalent plain python code as your
+modules are imported; see withhacks.importhook for the details.
+
+To find out what the hacks are costing you, enable_stats() records entry
+and exit counts, timings and cache hits for each with-statement that uses
+them, available from stats(); see withhacks.instrument for the details.
+
+Processes that start often can share the code compiled by the hacks through
+a cache directory, set with set_cache_dir() or the WITHHACKS_CACHE_DIR
+environment variable; see withhacks.diskcache for the details.
+
+To do the work of capturing and compiling each with-statement before it's
+first executed, for example before forking worker processes, pass your
+modules or functions to precompile().
 
 WithHacks makes extensive use of Noam Raphael's fantastic "byteplay" module;
 since the official byteplay distribution doesn't support Python 2.6, a local
@@ -40,16 +60,49 @@ from .__about__ import *
 
 import sys
 import types
-import copy
-import inspect
-import bytecode
+import opcode
+import functools
+import itertools
+import collections
+import weakref
+
+from withhacks._lazy import LazyModule
+from withhacks.frameutils import load_name, extract_code, inject_trace_func, \
+                                 update_locals, index_with_blocks, _is_instr, \
+                                 _CodeDict, _AS_CLAUSE_ENDS
+from withhacks.portable import PortableFunction
+from withhacks.diskcache import set_cache_dir, get_cache_dir
+from withhacks import diskcache
+from withhacks.instrument import stats, reset_stats, enable_stats, \
+                                 disable_stats, stats_enabled, \
+                                 add_stats_callback, remove_stats_callback
+
+#  These are only needed once a block is captured or compiled, so importing
+#  withhacks doesn't pay for them up front.
+_bytecode = LazyModule("bytecode",globals())
+_copy = LazyModule("copy",globals())
+_dis = LazyModule("dis",globals())
+_inspect = LazyModule("inspect",globals())
+
+
+def install_import_hook(packages):
+    """Install an import hook rewriting with-statement hacks in packages.
+
+    See withhacks.importhook for the details; it's only imported when the
+    hook is first installed.
+    """
+    from withhacks import importhook
+    return importhook.install_import_hook(packages)
+
 
-try:
-    import threading
-except ImportError:
-    import dummy_threading as threading
+def uninstall_import_hook(finder=None):
+    """Uninstall an import hook installed by install_import_hook().
 
-from withhacks.frameutils import load_name, extract_code, inject_trace_func
+    If no finder is given, all withhacks import hooks are removed.
+    """
+    importhook = sys.modules.get("withhacks.importhook")
+    if importhook is not None:
+        importhook.uninstall_import_hook(finder)
 
 
 class _ExitContext(Exception):
@@ -57,8 +110,18 @@ class _ExitContext(Exception):
     pass
 
 
+#  Opcodes run by an "async with" statement between __aenter__ and its block.
+_ASYNC_ENTER_OPS = frozenset(opcode.opmap[nm] for nm in ("YIELD_FROM","SETUP_ASYNC_WITH")
+                             if nm in opcode.opmap)
+
+
 def _exit_context(frame):
     """Simple function to throw an _ExitContext exception."""
+    #  An "async with" statement awaits __aenter__ before setting up its
+    #  block, so wait until the frame has moved on into the block.
+    if frame.f_code.co_code[frame.f_lasti] in _ASYNC_ENTER_OPS:
+        inject_trace_func(frame,_exit_context)
+        return
     raise _ExitContext
 
 
@@ -67,6 +130,259 @@ class _Bucket:
     pass
 
 
+#  Sentinel returned by lookups in a namespace when the name isn't there.
+_missing = object()
+
+
+#  Cache of call sites for each with-statement that has been captured.
+#  It maps code objects to a dict of {start: _CallSite}, where "start" is the
+#  offset of the with-statement, and holds the code objects weakly so that
+#  entries go away with their modules.
+_capture_cache = _CodeDict()
+
+
+class _CallSite(object):
+    """Bytecode captured from a with-statement, and things compiled from it.
+
+    The "body" and "as_clause" attributes hold the trimmed bytecode, which
+    must not be modified.  The "is_async" attribute is true if it came from
+    an "async with" statement.  The "compiled" dict is where WithHack
+    subclasses can stash code objects they build from the bytecode, so that
+    they need only be built once for each call site.  The "location"
+    attribute is a tuple (code_ref,start) giving a weak reference to the
+    enclosing code object and the offset of the with-statement within it.
+    """
+
+    def __init__(self,body,as_clause,is_async=False,location=None):
+        self.body = body
+        self.as_clause = as_clause
+        self.is_async = is_async
+        self.location = location
+        self.compiled = {}
+
+
+def _get_call_site(code,start,end=None):
+    """Get the cached _CallSite for the with-statement at offset "start".
+
+    The bytecode is taken from an index of all the with-statements in the
+    code object.  None is returned if there's no with-statement at "start",
+    if "end" is given and it's not where the with-statement exits, or if
+    the code object can't be indexed.
+    """
+    try:
+        sites = _capture_cache[code]
+    except KeyError:
+        sites = _capture_cache.setdefault(code,{})
+    try:
+        return sites[start]
+    except KeyError:
+        pass
+    try:
+        (bc,blocks) = index_with_blocks(code)
+    except Exception:
+        #  Code that can't be indexed is captured the slow way instead.
+        return None
+    block = blocks.get(start)
+    if block is None or (end is not None and block.exit_offset != end):
+        return None
+    body = _copy.copy(bc)
+    body[:] = bc[block.body]
+    as_clause = _copy.copy(bc)
+    as_clause[:] = bc[block.as_clause]
+    site = sites[start] = _CallSite(body,as_clause,block.is_async,
+                                    (weakref.ref(code),start))
+    return site
+
+
+def _store_names(bc):
+    """Get the names of variables stored to by the given bytecode.
+
+    The names are returned as a tuple, in order of first assignment.
+    """
+    names = {}
+    for instr in bc:
+        if _is_instr(instr,'STORE_FAST','STORE_NAME','STORE_DEREF'):
+            # DEREF instructions have CellVar/FreeVar arguments
+            names.setdefault(getattr(instr.arg,"name",instr.arg),len(names))
+    return tuple(sorted(names,key=names.get))
+
+
+#  Cache of the code objects of each WithHack subclass's methods, used to
+#  tell the frames of the hack's own machinery from the with-statement's.
+_method_codes = weakref.WeakKeyDictionary()
+
+
+def _get_method_codes(cls):
+    """Get the set of ids of code objects for the methods of the given class.
+
+    This includes methods inherited from its bases, the functions wrapped by
+    staticmethod, classmethod and property objects, and any functions (such
+    as lambdas) that are defined inside those methods.  Ids are used since
+    hashing a code object means hashing all of its constants and names; the
+    code objects themselves are kept alive alongside them in the cache.
+    """
+    try:
+        return _method_codes[cls][0]
+    except KeyError:
+        pass
+    codes = set()
+    def add_code(code):
+        if code not in codes:
+            codes.add(code)
+            for const in code.co_consts:
+                if isinstance(const,types.CodeType):
+                    add_code(const)
+    def add_func(obj):
+        if isinstance(obj,(staticmethod,classmethod)):
+            obj = obj.__func__
+        while obj is not None:
+            code = getattr(obj,"__code__",None)
+            if isinstance(code,types.CodeType):
+                add_code(code)
+            obj = getattr(obj,"__wrapped__",None)
+    for klass in cls.__mro__:
+        for value in klass.__dict__.values():
+            if isinstance(value,property):
+                for func in (value.fget,value.fset,value.fdel):
+                    add_func(func)
+            else:
+                add_func(value)
+    ids = frozenset(id(code) for code in codes)
+    _method_codes[cls] = (ids,codes)
+    return ids
+
+
+#  Instructions that can only appear in the code of a coroutine.
+_ASYNC_INSTRS = ('GET_AWAITABLE','GET_AITER','GET_ANEXT','BEFORE_ASYNC_WITH',
+                 'SETUP_ASYNC_WITH')
+
+
+def _set_coroutine_flags(code,coroutine):
+    """Make a bytecode.Bytecode object for a coroutine, or a plain function.
+
+    The captured bytecode carries the flags of the enclosing code object,
+    which are only right if the block was captured from a function of the
+    same kind.  Generator functions are left alone.
+    """
+    if coroutine:
+        generator_flags = (_inspect.CO_GENERATOR | _inspect.CO_COROUTINE |
+                           _inspect.CO_ITERABLE_COROUTINE |
+                           getattr(_inspect,"CO_ASYNC_GENERATOR",0))
+        code.flags = (code.flags & ~generator_flags) | _inspect.CO_COROUTINE
+    elif code.flags & _inspect.CO_COROUTINE:
+        code.flags &= ~_inspect.CO_COROUTINE
+
+
+def _compile_cached(site,key,compile):
+    """Get an object compiled from a call site, building it if needed.
+
+    This implements CaptureBytecode._compiled(), including the disk cache.
+    """
+    compiled = site.compiled
+    try:
+        return compiled[key]
+    except KeyError:
+        pass
+    path = None
+    if diskcache._cache_dir is not None and site.location is not None:
+        (code_ref,start) = site.location
+        code = code_ref()
+        if code is not None:
+            path = diskcache.cache_path(code,start,key)
+    value = None
+    if path is not None:
+        value = diskcache.load(path)
+    if value is None:
+        value = compile()
+        if path is not None:
+            diskcache.store(path,value)
+    compiled[key] = value
+    return value
+
+
+#  Opcodes binding names in the frame, which an "as" clause compiled into a
+#  separate function can't do.
+_BINDING_OPS = ('STORE_FAST','STORE_NAME','STORE_DEREF',
+                'DELETE_FAST','DELETE_NAME','DELETE_DEREF')
+
+
+def _compile_as_clause(as_clause):
+    """Compile the bytecode of an "as" clause into a reusable code object.
+
+    The code is for a function taking the value to store, the frame of the
+    with-statement and the load_name() function, the last as a default
+    argument so that the code can be marshalled.  Variables are looked up
+    in the frame through load_name().  None is returned if the clause binds
+    any names, since only the frame itself can do that.
+    """
+    Instr = _bytecode.Instr
+    code = _copy.copy(as_clause)
+    code[:] = [Instr('LOAD_FAST',"_[value]")]
+    for instr in as_clause:
+        if not isinstance(instr,_bytecode.instr.BaseInstr):
+            code.append(instr)
+        elif instr.name in _BINDING_OPS:
+            return None
+        elif instr.name in ('LOAD_FAST','LOAD_NAME','LOAD_DEREF',
+                            'LOAD_CLASSDEREF'):
+            name = getattr(instr.arg,"name",instr.arg)
+            code.extend([Instr('LOAD_FAST',"_[load_name]"),
+                         Instr('LOAD_FAST',"_[frame]"),
+                         Instr('LOAD_CONST',name),
+                         Instr('CALL_FUNCTION',2)])
+        else:
+            code.append(instr.copy())
+    code.extend([Instr('LOAD_CONST',None),Instr('RETURN_VALUE')])
+    code.flags = _inspect.CO_OPTIMIZED | _inspect.CO_NEWLOCALS | _inspect.CO_NOFREE
+    code.cellvars = []
+    code.freevars = []
+    code.argnames = ("_[value]","_[frame]","_[load_name]")
+    code.argcount = 3
+    code.name = "<as clause>"
+    return code.to_code()
+
+
+def _copy_bytecode(code):
+    """Copy a bytecode.Bytecode object, including its mutable instructions."""
+    new_code = _copy.copy(code)
+    new_code[:] = [instr.copy() if isinstance(instr,_bytecode.instr.BaseInstr)
+                   else instr for instr in code]
+    return new_code
+
+
+def _trim_with_block(bc):
+    """Split the bytecode of a with-statement into (body,as_clause,is_async).
+
+    The given bytecode must begin at or before the SETUP_WITH instruction
+    of the with-statement and end at its teardown code.  Each boundary is
+    found with a single scan, and the bytecode is then sliced just once.
+    """
+    # Find the code setting up the with-statement block.
+    for (setup,instr) in enumerate(bc):
+        if _is_instr(instr,'SETUP_WITH','SETUP_ASYNC_WITH'):
+            break
+    else:
+        raise ValueError("no with-statement found in captured bytecode")
+
+    # Find the code that belongs to the as clause.
+    for start in range(setup+1,len(bc)):
+        if _is_instr(bc[start],*_AS_CLAUSE_ENDS):
+            break
+    start += 1
+
+    # Find the code tearing down the with-statement block.
+    for end in range(len(bc)-1,start-1,-1):
+        if _is_instr(bc[end],'POP_BLOCK'):
+            break
+    else:
+        raise ValueError("end of with-statement not found in captured bytecode")
+
+    is_async = bc[setup].name == 'SETUP_ASYNC_WITH'
+    as_clause = _copy.copy(bc)
+    as_clause[:] = bc[setup+1:start]
+    bc[:] = bc[start:end]
+    return (bc,as_clause,is_async)
+
 
 class WithHack(object):
     """Base class for with-statement-related hackery.
@@ -83,8 +399,17 @@ class WithHack(object):
     the attribute "must_execute" to true, the block will be executed regardless
     of the setting of "dont_execute".  Having two settings allows hacks that
     want to skip the block to be combined with hacks that need it executed.
+
+    All WithHacks can also be used in "async with" statements inside
+    coroutines, where the contained block may use "await".
+
+    WithHack and its subclasses use __slots__ and don't hold on to the frame
+    of execution, so hack objects that outlive their with-statement are
+    cheap to keep around.
     """
 
+    __slots__ = ("__weakref__",)
+
     dont_execute = False
     must_execute = False
 
@@ -92,20 +417,24 @@ class WithHack(object):
         """Get the frame object corresponding to the with-statement context.
 
         This is designed to work from within superclass method call. It finds
-        the first frame in which the variable "self" is not bound to this 
-        object.  While this heuristic rules out some strange uses of WithHack
-        objects (such as entering on object inside its own __exit__ method)
-        it should suffice in practise.
+        the first frame that isn't running one of the methods of this object's
+        class on this object.  While this heuristic rules out some strange
+        uses of WithHack objects (such as entering on object inside its own
+        __exit__ method) it should suffice in practise.
+
+        Frames are first checked by their code objects, so that the local
+        variables of the with-statement's frame never need to be looked at;
+        only frames running one of the class's methods are checked for being
+        called on another instance.  The frame is found afresh on each call
+        rather than being stored on the object, so that it isn't kept alive
+        after the block exits.
         """
-        try:
-            return self.__frame
-        except AttributeError:
-            # Offset 2 accounts for this method, and the one calling it.
-            f = sys._getframe(2)
-            while f.f_locals.get("self") is self:
-                f = f.f_back
-            self.__frame = f
-            return f
+        codes = _get_method_codes(type(self))
+        # Offset 2 accounts for this method, and the one calling it.
+        f = sys._getframe(2)
+        while id(f.f_code) in codes and f.f_locals.get("self",self) is self:
+            f = f.f_back
+        return f
 
     def _set_context_locals(self,locals):
         """Set local variables in the with-statement context.
@@ -113,8 +442,7 @@ class WithHack(object):
         The argument "locals" is a dictionary of name bindings to be inserted
         into the execution context of the with-statement.
         """
-        frame = self._get_context_frame()
-        inject_trace_func(frame,lambda frame: frame.f_locals.update(locals))
+        update_locals(self._get_context_frame(),locals)
 
     def __enter__(self):
         """Enter the context of this WithHack.
@@ -143,6 +471,21 @@ class WithHack(object):
         else:
             return False
 
+    async def __aenter__(self):
+        """Enter the context of this WithHack in an "async with" statement.
+
+        The base implementation just calls __enter__, which can find the
+        frame of the coroutine containing the with-statement as usual.
+        """
+        return self.__enter__()
+
+    async def __aexit__(self,exc_type,exc_value,traceback):
+        """Exit the context of this WithHack in an "async with" statement.
+
+        The base implementation just calls __exit__.
+        """
+        return self.__exit__(exc_type,exc_value,traceback)
+
 
 class CaptureBytecode(WithHack):
     """WithHack to capture the bytecode in the scope of a with-statement.
@@ -154,12 +497,28 @@ class CaptureBytecode(WithHack):
 
     If the with-statement contains an "as" clause, the name of the variable
     is stored in the attribute "as_name".
+
+    The trimmed bytecode for each call site is cached, so a with-statement
+    that runs repeatedly only disassembles its enclosing function once, and
+    the boundaries of all with-statements in that function are found in a
+    single pass.  Set the attribute "cache_bytecode" to false to disable this.
+
+    The prebuilt hacks that subclass this one drop their captured bytecode
+    once they have finished with it.  Set the attribute "keep_bytecode" to
+    true to keep it available after the with-statement.
     """
 
+    __slots__ = ("__bc_start","__site","__bytecode","__as_clause",
+                 "__as_site")
+
     dont_execute = True
+    cache_bytecode = True
+    keep_bytecode = True
 
     def __init__(self):
         self.__bc_start = None
+        self.__site = None
+        self.__as_site = None
         self.bytecode = None
         self._as_clause = None
         super(CaptureBytecode,self).__init__()
@@ -170,32 +529,171 @@ class CaptureBytecode(WithHack):
 
     def __exit__(self,*args):
         frame = self._get_context_frame()
-        bc = extract_code(frame,self.__bc_start,frame.f_lasti)
-
-        # Remove code setting up the with-statement block.
-        while not isinstance(bc[0], bytecode.instr.BaseInstr) or bc[0].name != 'SETUP_WITH':
-            bc[:] = bc[1:]
-        bc[:] = bc[1:]
-
-        # extract code that belongs to the as clause
-        as_clause = copy.copy(bc)
-        as_clause[:] = []
-        for i, instr in enumerate(bc):
-            as_clause.append(instr)
-            if instr.name.startswith('STORE') or instr.name == 'POP_TOP':
-                break
-        bc[:] = bc[i+1:]
-        self._as_clause = as_clause
-
-        # remove code tearing down the with-statement block
-        while not isinstance(bc[-1], bytecode.instr.BaseInstr) or bc[-1].name != 'POP_BLOCK':
-            bc[:] = bc[:-1]
-        bc[:] = bc[:-1]
-
-        # save the trimmed bytecode
-        self.bytecode = bc
+        site = self._capture_site(frame,self.__bc_start,frame.f_lasti)
+        self.__site = site
+        self.__as_site = site
         return super(CaptureBytecode,self).__exit__(*args)
 
+    @property
+    def bytecode(self):
+        """The trimmed bytecode of the with-statement's block.
+
+        This is copied from the call site on first access, so hacks that
+        only use compiled code from the cache never pay for the copy.
+        """
+        if self.__bytecode is None and self.__site is not None:
+            self.__bytecode = _copy_bytecode(self.__site.body)
+        return self.__bytecode
+
+    @bytecode.setter
+    def bytecode(self,value):
+        self.__bytecode = value
+
+    @property
+    def _as_clause(self):
+        """The bytecode of the with-statement's "as" clause."""
+        if self.__as_clause is None and self.__as_site is not None:
+            self.__as_clause = _copy_bytecode(self.__as_site.as_clause)
+        return self.__as_clause
+
+    @_as_clause.setter
+    def _as_clause(self,value):
+        self.__as_clause = value
+
+    def _capture_site(self,frame,start,end):
+        """Capture the _CallSite for the with-statement.
+
+        If the attribute "cache_bytecode" is true, the call site is cached so
+        that the enclosing function need only be disassembled once.
+        """
+        self.bytecode = None
+        self._as_clause = None
+        location = (weakref.ref(frame.f_code),start)
+        if not self.cache_bytecode:
+            return _CallSite(*_trim_with_block(extract_code(frame,start,end)),
+                             location=location)
+        site = _get_call_site(frame.f_code,start,end)
+        if site is None:
+            #  Not where we expected a with-statement; do it the slow way.
+            site = _CallSite(*_trim_with_block(extract_code(frame,start,end)),
+                             location=location)
+            _capture_cache[frame.f_code][start] = site
+        return site
+
+    @property
+    def _is_async(self):
+        """Whether the block belongs to an "async with" statement."""
+        return self.__site is not None and self.__site.is_async
+
+    def _is_coroutine_block(self):
+        """Whether code compiled from the block must be a coroutine.
+
+        This is the case for the block of an "async with" statement, and for
+        any block containing an "await" or other coroutine-only construct.
+        """
+        return self._is_async or any(_is_instr(instr,*_ASYNC_INSTRS)
+                                     for instr in self.bytecode)
+
+    def _compile_block(self,argnames,name,return_locals=False):
+        """Compile the captured bytecode into a self-contained function.
+
+        The function takes the arguments named in "argnames", which should
+        include any locals of the enclosing frame that the block uses, and
+        returns whatever the block returns.  If "return_locals" is true, it
+        instead returns a tuple (retval,locals) so that the variables it
+        assigns can be passed back.  The function doesn't refer to the frame
+        at all, so it can be run in another thread or process.
+        """
+        Instr = _bytecode.Instr
+        funcode = _copy.copy(self.bytecode)
+        funcode.append(Instr('LOAD_CONST', None))
+        funcode.append(Instr('RETURN_VALUE'))
+        self._change_lookups(funcode, args=argnames)
+        #  No DEREF instructions are left, so there are no cells to set up.
+        funcode.cellvars = []
+        funcode.freevars = []
+        _set_coroutine_flags(funcode, False)
+        if return_locals:
+            #  Make each return also return the function's locals.  The
+            #  builtin is loaded by name so that the code can be marshalled.
+            for i in range(len(funcode)-1,-1,-1):
+                instr = funcode[i]
+                if _is_instr(instr,'RETURN_VALUE'):
+                    lineno = instr.lineno
+                    funcode[i:i+1] = [Instr('LOAD_GLOBAL','locals',lineno=lineno),
+                                      Instr('CALL_FUNCTION',0,lineno=lineno),
+                                      Instr('BUILD_TUPLE',2,lineno=lineno),
+                                      Instr('RETURN_VALUE',lineno=lineno)]
+        funcode.name = name
+        funcode.argnames = argnames
+        funcode.argcount = len(argnames)
+        return funcode.to_code()
+
+    def _release_bytecode(self,as_clause=True):
+        """Drop the captured bytecode, unless "keep_bytecode" is true.
+
+        Subclasses call this once they're done with the bytecode.  If the
+        argument "as_clause" is false, the "as" clause is kept for a later
+        call to _run_as_clause, which drops it in turn.
+        """
+        if not self.keep_bytecode:
+            self.__site = None
+            self.__bytecode = None
+            if as_clause:
+                self.__as_clause = None
+                self.__as_site = None
+
+    def _compiled(self,key,compile):
+        """Get an object compiled from this call site, building it if needed.
+
+        The given "compile" function is called with no arguments the first
+        time a given key is requested for this call site, and its result is
+        cached for subsequent executions of the with-statement.  If a cache
+        directory is set, code objects compiled under tuple keys are also
+        cached on disk and shared between processes; see withhacks.diskcache.
+        """
+        return _compile_cached(self.__site,key,compile)
+
+    @classmethod
+    def _precompile(cls,site):
+        """Compile what can be compiled ahead of time for a call site.
+
+        This is called by precompile() with the _CallSite of each with-
+        statement found to use the class, so that the first execution of the
+        block doesn't pay for it.  The capture itself is already cached, so
+        the base implementation does nothing.
+        """
+        pass
+
+    @classmethod
+    def _for_site(cls,site):
+        """Create a bare instance of the class, bound to the given call site.
+
+        The class's own __init__ isn't run, so the instance is only good for
+        calling _compiled() and the methods that work on the bytecode.
+        """
+        hack = cls.__new__(cls)
+        CaptureBytecode.__init__(hack)
+        hack.__site = site
+        hack.__as_site = site
+        return hack
+
+    def _as_target_name(self):
+        """Get the variable name that the as clause assigns to, if any.
+
+        None is returned unless the as clause is a single store to a local,
+        global or closure variable.
+        """
+        as_clause = self.__as_clause
+        if as_clause is None and self.__as_site is not None:
+            as_clause = self.__as_site.as_clause
+        if not as_clause or len(as_clause) != 1:
+            return None
+        first = as_clause[0]
+        if first.name not in ('STORE_FAST','STORE_NAME','STORE_DEREF'):
+            return None
+        return getattr(first.arg,"name",first.arg)
+
     def _run_as_clause(self, value):
         """
         Run the as clause, setting the target expression to `value`
@@ -204,38 +702,62 @@ class CaptureBytecode(WithHack):
 
             with somehack as d['item'][i].foo().bar:
                 pass
-        """
-        assert self._as_clause
 
-        if len(self._as_clause) == 1:
-            first = self._as_clause[0]
-            # store_fast has to be handled specially
-            if first.name == 'STORE_FAST':
-                self._set_context_locals({first.arg: value})
+        Unless the as clause has been modified, it's compiled into a function
+        taking the value and the frame just once for each call site, so each
+        execution costs a single function call.
+        """
+        as_site = self.__as_site
+        as_clause = self.__as_clause
+        if not self.keep_bytecode:
+            self.__as_clause = None
+            self.__as_site = None
+        if as_clause is None and as_site is not None:
+            as_clause = as_site.as_clause
+        assert as_clause
+
+        if len(as_clause) == 1:
+            first = as_clause[0]
+            # stores to local names have to be handled specially
+            if first.name in ('STORE_FAST','STORE_NAME','STORE_DEREF'):
+                name = getattr(first.arg,"name",first.arg)
+                self._set_context_locals({name: value})
                 return
             # pop_top is a no-op
             elif first.name == 'POP_TOP':
                 return
 
+        frame = self._get_context_frame()
+        if as_site is not None and as_clause is as_site.as_clause:
+            code = _compile_cached(as_site,(CaptureBytecode,"as_clause"),
+                                   lambda: _compile_as_clause(as_clause))
+            if code is not None:
+                func = types.FunctionType(code,frame.f_globals,None,
+                                          (load_name,))
+                func(value,frame)
+                return
+            as_clause = _copy_bytecode(as_clause)
+        self._exec_as_clause(frame,as_clause,value)
+
+    def _exec_as_clause(self, frame, as_clause, value):
+        """Run an as clause that binds names, by exec'ing it in the frame."""
         # if somehow there's a STORE_FAST in there, it's not going to work
-        if any(instr.name == 'STORE_FAST' for instr in self._as_clause):
+        if any(_is_instr(instr,'STORE_FAST') for instr in as_clause):
             raise NotImplementedError("Cannot handle this as clause")
 
-        frame = self._get_context_frame()
-
         # prepend a LOAD_CONST with a dummy value
         dummy = object()
-        code = copy.copy(self._as_clause)
-        code[:0] = [bytecode.Instr('LOAD_CONST', dummy)]
+        code = _copy.copy(as_clause)
+        code[:0] = [_bytecode.Instr('LOAD_CONST', dummy)]
         code.extend([
-            bytecode.Instr('LOAD_CONST', None),
-            bytecode.Instr('RETURN_VALUE')
+            _bytecode.Instr('LOAD_CONST', None),
+            _bytecode.Instr('RETURN_VALUE')
         ])
 
         # configure the object
         code.argcount = 0
         code.name = '<as clause>'
-        code.flags &= ~inspect.CO_NEWLOCALS
+        code.flags &= ~_inspect.CO_NEWLOCALS
 
         # fiddle with variable lookups
         self._change_lookups(code, locals=frame.f_locals)
@@ -258,32 +780,46 @@ class CaptureBytecode(WithHack):
         TODO: does this work for STORE_FAST, DELETE_FAST?
         """
         for instr in code:
-            if not isinstance(instr, bytecode.instr.BaseInstr):
+            if not isinstance(instr, _bytecode.instr.BaseInstr):
                 continue
+            # DEREF instructions have CellVar/FreeVar arguments
+            name = getattr(instr.arg,"name",instr.arg)
             if instr.name in ('LOAD_FAST','LOAD_DEREF','LOAD_NAME','LOAD_GLOBAL'):
-                if instr.arg in args:
-                    instr.name = 'LOAD_FAST'
+                if name in args:
+                    instr.set('LOAD_FAST', name)
                 elif instr.name in ('LOAD_FAST','LOAD_DEREF',):
-                    if instr.arg in locals:
-                        instr.name = 'LOAD_NAME'
+                    if name in locals:
+                        instr.set('LOAD_NAME', name)
                     else:
-                        instr.name = 'LOAD_FAST'
+                        instr.set('LOAD_FAST', name)
             elif instr.name in ('STORE_FAST','STORE_DEREF','STORE_NAME','STORE_GLOBAL'):
-                if instr.arg in args:
-                    instr.name = 'STORE_FAST'
+                if name in args:
+                    instr.set('STORE_FAST', name)
                 elif instr.name in ('STORE_FAST','STORE_DEREF',):
-                    if instr.arg in locals:
-                        instr.name = 'STORE_NAME'
+                    if name in locals:
+                        instr.set('STORE_NAME', name)
                     else:
-                        instr.name = 'STORE_FAST'
+                        instr.set('STORE_FAST', name)
             elif instr.name in ('DELETE_FAST','DELETE_NAME','DELETE_GLOBAL'):
-                if instr.arg in args:
-                    instr.name = 'DELETE_FAST'
+                if name in args:
+                    instr.set('DELETE_FAST', name)
                 elif instr.name in ('DELETE_FAST',):
-                    if instr.arg in locals:
-                        instr.name = 'DELETE_NAME'
+                    if name in locals:
+                        instr.set('DELETE_NAME', name)
                     else:
-                        instr.name = 'DELETE_FAST'
+                        instr.set('DELETE_FAST', name)
+
+    def _lookup_names(self):
+        """Get the names whose lookups depend on the enclosing frame."""
+        names = set()
+        for instr in self.bytecode:
+            if not isinstance(instr, _bytecode.instr.BaseInstr):
+                continue
+            if instr.name in ('LOAD_FAST','LOAD_DEREF','STORE_FAST',
+                              'STORE_DEREF','DELETE_FAST'):
+                # DEREF instructions have CellVar/FreeVar arguments
+                names.add(getattr(instr.arg,"name",instr.arg))
+        return frozenset(names)
 
 
 class CaptureFunction(CaptureBytecode):
@@ -298,6 +834,7 @@ class CaptureFunction(CaptureBytecode):
         * varkwargs:  boolean indicating present of a *kwargs argument
         * name:       name associated with the function object
         * argdefs:    tuple of default values for arguments
+        * portable:   boolean indicating the function should be picklable
 
     Here's a quick example:
 
@@ -310,45 +847,91 @@ class CaptureFunction(CaptureBytecode):
         hello world
         >>>
 
+    The code object for the function is compiled on the first execution of
+    the with-statement and cached, so later executions only need to build a
+    new function object using the current globals and "argdefs".
+
+    If the block belongs to an "async with" statement, or contains "await",
+    the function is a coroutine function.
+
+    If "portable" is true, the function is wrapped in a PortableFunction so
+    that it can be pickled and sent to other processes, for example through
+    a ProcessPoolExecutor; see withhacks.portable for the details.
     """
 
+    __slots__ = ("__args","__varargs","__varkwargs","__name","__argdefs",
+                 "__portable","function")
+    keep_bytecode = False
+
     def __init__(self,args=[],varargs=False,varkwargs=False,name="<withhack>",
-                      argdefs=()):
+                      argdefs=(),portable=False):
         self.__args = args
         self.__varargs = varargs
         self.__varkwargs = varkwargs
         self.__name = name
         self.__argdefs = argdefs
+        self.__portable = portable
         super(CaptureFunction,self).__init__()
 
     def __exit__(self,*args):
         frame = self._get_context_frame()
         retcode = super(CaptureFunction,self).__exit__(*args)
-        funcode = copy.copy(self.bytecode)
-        #  Ensure it's a properly formed func by always returning something
-        funcode.append(bytecode.Instr('LOAD_CONST', None))
-        funcode.append(bytecode.Instr('RETURN_VALUE'))
-        self._change_lookups(funcode, args=self.__args, locals=frame.f_locals)
+        #  The code depends on which names are locals in the enclosing frame,
+        #  so those form part of the key under which it is cached.
+        f_locals = frame.f_locals
+        names = self._compiled("lookup_names",self._lookup_names)
+        outer = frozenset(nm for nm in names if nm in f_locals)
+        key = (CaptureFunction,type(self),tuple(self.__args),self.__varargs,
+               self.__varkwargs,self.__name,outer)
+        code = self._compiled(key,lambda: self._compile_function(outer))
 
         #  Create the resulting function object
+        gs = frame.f_globals
+        nm = self.__name
+        defs = self.__argdefs
+        self.function = types.FunctionType(code,gs,nm,defs)
+        if self.__portable:
+            self.function = PortableFunction(self.function)
+        self._release_bytecode()
+        return retcode
+
+    def _compile_function(self,outer):
+        """Compile the captured bytecode into a code object for the function.
+
+        The argument "outer" is the set of names that are bound as locals
+        in the enclosing frame.  The result depends only on that and on the
+        signature, so it can be reused by later executions of the block.
+        """
+        funcode = _copy.copy(self.bytecode)
+        #  Ensure it's a properly formed func by always returning something
+        funcode.append(_bytecode.Instr('LOAD_CONST', None))
+        funcode.append(_bytecode.Instr('RETURN_VALUE'))
+        self._change_lookups(funcode, args=self.__args, locals=outer)
+        #  No DEREF instructions are left, so there are no cells to set up.
+        funcode.cellvars = []
+        funcode.freevars = []
+
         # funcode.args = self.__args
         # funcode.varargs = self.__varargs
         # funcode.varkwargs = self.__varkwargs
+        _set_coroutine_flags(funcode, self._is_coroutine_block())
         funcode.name = self.__name
         funcode.argnames = self.__args
         funcode.argcount = len(self.__args)
         if self.__varargs:
-            funcode.flags |= inspect.CO_VARARGS
+            funcode.flags |= _inspect.CO_VARARGS
             funcode.argcount -= 1
         if self.__varkwargs:
-            funcode.flags |= inspect.CO_VARKEYWORDS
+            funcode.flags |= _inspect.CO_VARKEYWORDS
             funcode.argcount -= 1
+        return funcode.to_code()
 
-        gs = self._get_context_frame().f_globals
-        nm = self.__name
-        defs = self.__argdefs
-        self.function = types.FunctionType(funcode.to_code(),gs,nm,defs)
-        return retcode
+    @classmethod
+    def _precompile(cls,site):
+        #  The code itself depends on the arguments and the enclosing
+        #  frame's locals, so only the name analysis can be done early.
+        hack = cls._for_site(site)
+        hack._compiled("lookup_names",hack._lookup_names)
 
 
 class CaptureLocals(CaptureBytecode):
@@ -366,39 +949,63 @@ class CaptureLocals(CaptureBytecode):
         True
         >>>
 
+    The names assigned to in the block are found from its bytecode on the
+    first execution of the with-statement and cached, so later executions
+    only read those variables from the frame.  A variable that is assigned
+    somewhere in the block but hasn't been bound when it exits is left out.
     """
 
+    __slots__ = ("locals",)
+
     must_execute = True
+    keep_bytecode = False
     dest_type = dict
 
     def __exit__(self,*args):
         retcode = super(CaptureLocals,self).__exit__(*args)
         frame = self._get_context_frame()
-        self.locals = self.dest_type()
-        for instr in self.bytecode:
-           if instr.name in ('STORE_FAST','STORE_NAME'):
-               self.locals[instr.arg] = frame.f_locals[instr.arg]
+        names = self._compiled("store_names",lambda: _store_names(self.bytecode))
+        f_locals = frame.f_locals
+        self.locals = locals = self.dest_type()
+        for name in names:
+            value = f_locals.get(name,_missing)
+            if value is not _missing:
+                locals[name] = value
+        #  Subclasses such as xargs go on to run the "as" clause.
+        self._release_bytecode(as_clause=False)
         return retcode
 
+    @classmethod
+    def _precompile(cls,site):
+        hack = cls._for_site(site)
+        hack._compiled("store_names",lambda: _store_names(site.body))
+
 
 class CaptureOrderedLocals(CaptureLocals):
     """WithHack to capture local variables modified in the block, in order.
 
-    When the block exits, the attribute "locals" will be a list containing
-    a (name,value) pair for each local variable created or modified during
-    the execution of the block.   The variables are listed in the order
-    they are first assigned.
+    When the block exits, the attribute "locals" will be an ordered mapping
+    containing each local variable created or modified during the execution
+    of the block.   The variables are listed in the order they are first
+    assigned.
 
         >>> with CaptureOrderedLocals() as f:
         ...     x = 7
         ...     y = 8
         ...
-        >>> f.locals
-        OrderedDict([('x', 7), ('y', 8)])
+        >>> list(f.locals.items())
+        [('x', 7), ('y', 8)]
         >>>
 
     """
-    from collections import OrderedDict as dest_type
+
+    __slots__ = ()
+
+    if sys.version_info >= (3,7):
+        #  Plain dicts preserve insertion order.
+        dest_type = dict
+    else:
+        from collections import OrderedDict as dest_type
 
 
 class CaptureModifiedLocals(WithHack):
@@ -421,24 +1028,84 @@ class CaptureModifiedLocals(WithHack):
     This differs from CaptureLocals in that it does not detect variables
     that are assigned within the block if their value doesn't actually
     change.  It's cheaper to test for but not as reliable.
+
+    By default every local variable is snapshotted on entry and compared
+    with "!=" on exit.  If the argument "assigned_only" is true, only the
+    variables that the block can assign to are considered, as found from
+    its bytecode; the snapshot and comparison then cost time proportional
+    to the block rather than to the enclosing scope.  In this mode values
+    are compared by identity, falling back to "!=" only if the argument
+    "equality" is true.
+
+        >>> items = [1,2]
+        >>> with CaptureModifiedLocals(assigned_only=True) as f:
+        ...     items = [1,2]
+        ...
+        >>> list(f.locals)
+        ['items']
+
+    If the block can't be found in the bytecode, all local variables are
+    considered as usual.
     """
 
+    __slots__ = ("__assigned_only","__equality","__names","__pre_locals",
+                 "locals")
+
+    def __init__(self,assigned_only=False,equality=None):
+        if equality is None:
+            equality = not assigned_only
+        self.__assigned_only = assigned_only
+        self.__equality = equality
+        super(CaptureModifiedLocals,self).__init__()
+
     def __enter__(self):
         frame = self._get_context_frame()
-        self.__pre_locals = frame.f_locals.copy()
+        f_locals = frame.f_locals
+        names = None
+        if self.__assigned_only:
+            site = _get_call_site(frame.f_code,frame.f_lasti)
+            if site is not None:
+                try:
+                    names = site.compiled["store_names"]
+                except KeyError:
+                    names = site.compiled["store_names"] = _store_names(site.body)
+        if names is None:
+            self.__pre_locals = f_locals.copy()
+        else:
+            self.__pre_locals = pre_locals = {}
+            for name in names:
+                value = f_locals.get(name,_missing)
+                if value is not _missing:
+                    pre_locals[name] = value
+        self.__names = names
         return super(CaptureModifiedLocals,self).__enter__()
 
+    @classmethod
+    def _precompile(cls,site):
+        if "store_names" not in site.compiled:
+            site.compiled["store_names"] = _store_names(site.body)
+
     def __exit__(self,*args):
         frame = self._get_context_frame()
+        f_locals = frame.f_locals
+        if self.__names is None:
+            items = f_locals.items()
+        else:
+            items = ((nm,f_locals.get(nm,_missing)) for nm in self.__names)
+        pre_locals = self.__pre_locals
+        equality = self.__equality
         self.locals = {}
-        for (name,value) in frame.f_locals.items():
-            if value is self:
-                pass
-            elif name not in self.__pre_locals:
-                self.locals[name] = value
-            elif self.__pre_locals[name] != value:
-                self.locals[name] = value
+        for (name,value) in items:
+            if value is self or value is _missing:
+                continue
+            old_value = pre_locals.get(name,_missing)
+            if value is old_value:
+                continue
+            if old_value is not _missing and equality and old_value == value:
+                continue
+            self.locals[name] = value
         del self.__pre_locals
+        self.__names = None
         return super(CaptureModifiedLocals,self).__exit__(*args)
 
 
@@ -461,6 +1128,8 @@ class xargs(CaptureOrderedLocals):
 
     """
 
+    __slots__ = ("__func","__args","__kwds")
+
     def __init__(self,func,*args,**kwds):
         self.__func = func
         self.__args = args
@@ -494,6 +1163,8 @@ class xkwargs(CaptureLocals,CaptureBytecode):
 
     """
 
+    __slots__ = ("__func","__args","__kwds")
+
     def __init__(self,func,*args,**kwds):
         self.__func = func
         self.__args = args
@@ -527,6 +1198,9 @@ class namespace(CaptureBytecode):
         >>> sys.copyright2 == sys.copyright
         True
 
+    Names that aren't attributes of the object are looked up in the enclosing
+    scopes as usual.
+
     If no object is passed to the constructor, an empty object is created and
     used.  To get a reference to the namespace, use an "as" clause:
 
@@ -540,89 +1214,159 @@ class namespace(CaptureBytecode):
 
     """
 
+    __slots__ = ("namespace","__awaitable")
+    keep_bytecode = False
+
     def __init__(self,ns=None):
         if ns is None:
             self.namespace = _Bucket()
         else:
             self.namespace = ns
+        self.__awaitable = None
         super(namespace,self).__init__()
 
     def __exit__(self,*args):
         frame = self._get_context_frame()
         retcode = super(namespace,self).__exit__(*args)
-        # funcode = copy.deepcopy(self.bytecode)
-        funcode = copy.copy(self.bytecode)
+        code = self._compiled((namespace,type(self)),self._compile_namespace)
+        #  Execute bytecode in context of namespace
+        func = types.FunctionType(code,frame.f_globals,None,_NAMESPACE_DEFAULTS)
+        retval = func(self._block_namespace(),frame)
+        if isinstance(retval,types.CoroutineType):
+            #  The block contains "await", so __aexit__ must await it and
+            #  then finish off the block.
+            if not self._is_async:
+                retval.close()
+                raise NotImplementedError("use 'async with' for a block "
+                                          "containing 'await'")
+            self.__awaitable = retval
+        else:
+            self._finish_block()
+        return retcode
+
+    async def __aexit__(self,*args):
+        retcode = self.__exit__(*args)
+        awaitable = self.__awaitable
+        if awaitable is not None:
+            self.__awaitable = None
+            await awaitable
+            self._finish_block()
+        return retcode
+
+    def _finish_block(self):
+        """Finish off the block once it has run without error."""
+        self._block_done()
+        self._run_as_clause(self.namespace)
+        self._release_bytecode()
+
+    def _block_namespace(self):
+        """Get the object that the block's names are looked up in.
+
+        This is the namespace itself, but subclasses may substitute some
+        stand-in for it while the block runs.
+        """
+        return self.namespace
+
+    def _block_done(self):
+        """Called once the block has run to completion without error."""
+        pass
+
+    def _compile_namespace(self):
+        """Compile the captured bytecode to run against the namespace.
+
+        The resulting code object takes the namespace and the frame to use
+        for fallback name lookups as arguments, so it can be reused for
+        every execution of the with-statement.  It must be called with
+        _NAMESPACE_DEFAULTS as its default argument values.
+        """
+        funcode = _copy.copy(self.bytecode)
         #  Ensure it's a properly formed func by always returning something
-        funcode.append(bytecode.Instr('LOAD_CONST', None))
-        funcode.append(bytecode.Instr('RETURN_VALUE'))
+        funcode.append(_bytecode.Instr('LOAD_CONST', None))
+        funcode.append(_bytecode.Instr('RETURN_VALUE'))
         #  Switch LOAD/STORE/DELETE_FAST/NAME to LOAD/STORE/DELETE_ATTR
         to_replace = []
         for i, instr in enumerate(funcode):
-            repl = self._replace_opcode(instr, frame)
+            repl = self._replace_opcode(instr)
             if repl:
                 to_replace.append((i, repl))
         offset = 0
         for i, repl in to_replace:
             funcode[i+offset:i+offset+1] = repl
             offset += len(repl) - 1
-        #  Create function object to do the manipulation
-        funcode.argnames = ("_[namespace]",)
-        funcode.argcount = 1
+        #  Create code object to do the manipulation
+        _set_coroutine_flags(funcode, self._is_coroutine_block())
+        #  DEREF lookups now go through the frame, so there are no cells.
+        funcode.cellvars = []
+        funcode.freevars = []
+        #  Helpers are passed as default arguments rather than constants,
+        #  so that the code can be marshalled into the disk cache.
+        funcode.argnames = ("_[namespace]","_[frame]","_[getattr]",
+                            "_[load_name]","_[missing]")
+        funcode.argcount = 5
         funcode.name = "<withhack>"
-        gs = self._get_context_frame().f_globals
-        func = types.FunctionType(funcode.to_code(),gs)
-        #  Execute bytecode in context of namespace
-        retval = func(self.namespace)
-
-        self._run_as_clause(self.namespace)
-
-        return retcode
-
-    def _replace_opcode(self, instr, frame, *,
-                        _load=lambda i: [bytecode.Instr('LOAD_ATTR', i.arg)],
-                        _store=lambda i: [bytecode.Instr('STORE_ATTR', i.arg)],
-                        _delete=lambda i: [bytecode.Instr('DELETE_ATTR', i.arg)],
-                        _exc=AttributeError):
-        Instr = bytecode.Instr
-        Label = bytecode.Label
-
-        if instr.name in ('STORE_FAST','STORE_NAME',):
-            return [Instr('LOAD_FAST',"_[namespace]")] + _store(instr)
-        if instr.name in ('DELETE_FAST','DELETE_NAME',):
-            return [Instr('LOAD_FAST',"_[namespace]")] + _delete(instr)
+        return funcode.to_code()
+
+    @classmethod
+    def _precompile(cls,site):
+        hack = cls._for_site(site)
+        hack._compiled((namespace,cls),hack._compile_namespace)
+
+    def _replace_opcode(self, instr, *,
+                        _lookup=lambda i, name: [
+                            _bytecode.Instr('LOAD_FAST', "_[getattr]"),
+                            _bytecode.Instr('LOAD_FAST', "_[namespace]"),
+                            _bytecode.Instr('LOAD_CONST', name),
+                            _bytecode.Instr('LOAD_FAST', "_[missing]"),
+                            _bytecode.Instr('CALL_FUNCTION', 3)],
+                        _store=lambda i, name: [_bytecode.Instr('STORE_ATTR', name)],
+                        _delete=lambda i, name: [_bytecode.Instr('DELETE_ATTR', name)]):
+        Instr = _bytecode.Instr
+        Label = _bytecode.Label
+
+        if not isinstance(instr,_bytecode.instr.BaseInstr):
+            return None
+        # DEREF instructions have CellVar/FreeVar arguments
+        name = getattr(instr.arg,"name",instr.arg)
+        if instr.name in ('STORE_FAST','STORE_NAME','STORE_DEREF'):
+            return [Instr('LOAD_FAST',"_[namespace]")] + _store(instr, name)
+        if instr.name in ('DELETE_FAST','DELETE_NAME','DELETE_DEREF'):
+            return [Instr('LOAD_FAST',"_[namespace]")] + _delete(instr, name)
         if instr.name in ('LOAD_FAST','LOAD_NAME','LOAD_GLOBAL','LOAD_DEREF'):
-            excIn = Label(); excOut = Label(); end = Label()
-            # try:
-            #     x = namespace.<attr>
-            # except AttributeError:
-            #     x = load_name(frame, '<attr>')
-            return [Instr('SETUP_EXCEPT',excIn),
-                        Instr('LOAD_FAST',"_[namespace]")] + _load(instr) + [
-                        Instr('STORE_FAST',"_[ns_value]"),
-                        Instr('POP_BLOCK'), Instr('JUMP_FORWARD',end),
-                    excIn,
-                        Instr('DUP_TOP'), Instr('LOAD_CONST',_exc),
-                        Instr('COMPARE_OP',bytecode.Compare.EXC_MATCH),
-                        Instr('POP_JUMP_IF_FALSE',excOut), Instr('POP_TOP'),
-                        Instr('POP_TOP'), Instr('POP_TOP'),
-                        Instr('LOAD_CONST',load_name), Instr('LOAD_CONST',frame),
-                        Instr('LOAD_CONST',instr.arg), Instr('CALL_FUNCTION',2),
-                        Instr('STORE_FAST',"_[ns_value]"),
-                        Instr('POP_EXCEPT'),
-                        Instr('JUMP_FORWARD',end),
-                    excOut,
-                        Instr('END_FINALLY'),
-                    end,
-                        Instr('LOAD_FAST',"_[ns_value]")]
+            #  Names the compiler resolved as globals can be looked up
+            #  natively, since the function shares the frame's globals.
+            #  Anything else has to go through the frame's locals.
+            if instr.name == 'LOAD_GLOBAL':
+                fallback = [Instr('LOAD_GLOBAL',name)]
+            else:
+                fallback = [Instr('LOAD_FAST',"_[load_name]"),
+                            Instr('LOAD_FAST',"_[frame]"),
+                            Instr('LOAD_CONST',name), Instr('CALL_FUNCTION',2)]
+            end = Label()
+            # x = <lookup in namespace, or _missing>
+            # if x is _missing:
+            #     x = <lookup in enclosing scopes>
+            return _lookup(instr, name) + [
+                        Instr('DUP_TOP'), Instr('LOAD_FAST',"_[missing]"),
+                        Instr('COMPARE_OP',_bytecode.Compare.IS),
+                        Instr('POP_JUMP_IF_FALSE',end),
+                        Instr('POP_TOP')] + fallback + [
+                    end]
         return None
 
 
+#  Default argument values for the code compiled by namespace.
+_NAMESPACE_DEFAULTS = (getattr,load_name,_missing)
+
+
 class keyspace(namespace):
     """WithHack sending assignments to a specified dict-like object.
 
     This WithHack permits a construct simlar to the "with" statement from
     Visual Basic or JavaScript.  Inside a namespace context, all local
     variable accesses are actually accesses to the keys of that object.
+    Lookups index the object, so __missing__ and overridden __getitem__
+    methods are honoured, and names that aren't in it are looked up in the
+    enclosing scopes as usual.
 
         >>> import sys
         >>> with keyspace(sys.__dict__):
@@ -645,19 +1389,494 @@ class keyspace(namespace):
         1
         5
 
+    For mappings where each write is expensive, such as shelves or database
+    wrappers, pass buffered=True.  Assignments and deletions inside the block
+    then go to a local overlay, which lookups check before the mapping, and
+    the changes are written to the mapping all at once when the block exits.
+    By default this deletes the deleted keys and then calls update() with
+    the assigned ones; pass a function as "flush" to do the bulk write
+    yourself, given a dict of assigned items and a list of deleted keys.
+    If "transaction" is given, it's called with no arguments to get a
+    context manager wrapped around the flush:
+
+        >>> calls = []
+        >>> class Store(dict):
+        ...     def update(self,items):
+        ...         calls.append(sorted(items))
+        ...         super(Store,self).update(items)
+        ...
+        >>> with keyspace(Store(old=0),buffered=True) as ks:
+        ...     x = 1
+        ...     y = x + 4
+        ...     del old
+        ...
+        >>> calls
+        [['x', 'y']]
+        >>> sorted(ks.items())
+        [('x', 1), ('y', 5)]
+
+    If the block raises an exception, nothing is written.
+
     """
 
-    def __init__(self,ns=None):
+    __slots__ = ("__buffered","__flush","__transaction","__overlay")
+
+    def __init__(self,ns=None,buffered=False,flush=None,transaction=None):
         if ns is None:
             ns = {}
+        self.__buffered = buffered
+        self.__flush = flush
+        self.__transaction = transaction
+        self.__overlay = None
         super(keyspace,self).__init__(ns)
 
-    def _replace_opcode(self, instr, frame):
-        Instr = bytecode.Instr
-        return super()._replace_opcode(instr, frame,
-            _load=lambda i: [Instr('LOAD_CONST', i.arg), Instr('BINARY_SUBSCR')],
-            _store=lambda i: [Instr('LOAD_CONST', i.arg), Instr('STORE_SUBSCR')],
-            _delete=lambda i: [Instr('LOAD_CONST', i.arg), Instr('DELETE_SUBSCR')],
-            _exc=KeyError
+    def _block_namespace(self):
+        ns = self.namespace
+        if type(ns) is not dict:
+            ns = _ItemLookup(ns)
+        if not self.__buffered:
+            return ns
+        self.__overlay = _KeyspaceOverlay(ns)
+        return self.__overlay
+
+    def _block_done(self):
+        overlay = self.__overlay
+        if overlay is None:
+            return
+        self.__overlay = None
+        if self.__transaction is None:
+            self._flush(overlay.items,overlay.deleted)
+        else:
+            with self.__transaction():
+                self._flush(overlay.items,overlay.deleted)
+
+    def _flush(self,items,deleted):
+        """Write the changes buffered from the block to the mapping."""
+        if self.__flush is not None:
+            self.__flush(items,list(deleted))
+            return
+        ns = self.namespace
+        for key in deleted:
+            del ns[key]
+        if items:
+            ns.update(items)
+
+    def _replace_opcode(self, instr):
+        Instr = _bytecode.Instr
+        return super()._replace_opcode(instr,
+            _lookup=lambda i, name: [Instr('LOAD_FAST', "_[namespace]"),
+                                     Instr('LOAD_ATTR', 'get'),
+                                     Instr('LOAD_CONST', name),
+                                     Instr('LOAD_FAST', "_[missing]"),
+                                     Instr('CALL_FUNCTION', 2)],
+            _store=lambda i, name: [Instr('LOAD_CONST', name), Instr('STORE_SUBSCR')],
+            _delete=lambda i, name: [Instr('LOAD_CONST', name), Instr('DELETE_SUBSCR')]
         )
 
+
+class _KeyspaceOverlay(object):
+    """Overlay buffering the changes a keyspace block makes to a mapping.
+
+    Assigned items are kept in the dict "items" and deleted keys in the set
+    "deleted"; only keys present in the mapping are recorded as deleted.
+    """
+
+    __slots__ = ("mapping","items","deleted")
+
+    def __init__(self,mapping):
+        self.mapping = mapping
+        self.items = {}
+        self.deleted = set()
+
+    def get(self,key,default=None):
+        try:
+            return self.items[key]
+        except KeyError:
+            pass
+        if key in self.deleted:
+            return default
+        return self.mapping.get(key,default)
+
+    def __setitem__(self,key,value):
+        self.items[key] = value
+        self.deleted.discard(key)
+
+    def __delitem__(self,key):
+        if key in self.deleted or key not in self.mapping:
+            del self.items[key]
+        else:
+            self.items.pop(key,None)
+            self.deleted.add(key)
+
+
+class _ItemLookup(object):
+    """Adapter giving a mapping a get() method that goes through __getitem__.
+
+    The code compiled by keyspace looks names up with get(), which avoids
+    raising and catching KeyError for each name found in the enclosing
+    scopes.  That's only equivalent to indexing for plain dicts; other
+    mappings, which may define __missing__ or their own __getitem__, are
+    looked up through this adapter instead.
+    """
+
+    __slots__ = ("mapping",)
+
+    def __init__(self,mapping):
+        self.mapping = mapping
+
+    def get(self,key,default=None):
+        try:
+            return self.mapping[key]
+        except KeyError:
+            return default
+
+    def __contains__(self,key):
+        mapping = self.mapping
+        if hasattr(type(mapping),"__contains__"):
+            return key in mapping
+        try:
+            mapping[key]
+        except KeyError:
+            return False
+        return True
+
+    def __setitem__(self,key,value):
+        self.mapping[key] = value
+
+    def __delitem__(self,key):
+        del self.mapping[key]
+
+
+class run_in(CaptureBytecode):
+    """WithHack to run the block in the background using an executor.
+
+    The block is not executed in place.  Instead it is compiled into a
+    function and submitted to the given executor, which must have a submit()
+    method like those in concurrent.futures.  The "as" variable is bound to
+    a concurrent.futures.Future for the block, which can be passed to wait()
+    and as_completed().  When its result() is collected, any variables
+    assigned in the block are written back into the enclosing frame,
+    provided the "as" target is a plain variable still bound to the future.
+
+        >>> from concurrent.futures import ThreadPoolExecutor
+        >>> with ThreadPoolExecutor(1) as executor:
+        ...     n = 10
+        ...     with run_in(executor) as future:
+        ...         total = sum(range(n))
+        ...     future.result()
+        ...     print(total)
+        45
+
+    The block sees the values that local variables of the enclosing frame
+    had when it was submitted.  If the block returns a value, that is the
+    result of the future.
+
+    The submitted function is a PortableFunction, so process pools can be
+    used as long as the values of those local variables, and the variables
+    assigned in the block, can be pickled.
+    """
+
+    __slots__ = ("__executor","future")
+    keep_bytecode = False
+
+    def __init__(self,executor):
+        self.__executor = executor
+        super(run_in,self).__init__()
+
+    def __exit__(self,*args):
+        frame = self._get_context_frame()
+        retcode = super(run_in,self).__exit__(*args)
+        f_locals = frame.f_locals
+        #  Local variables of the enclosing frame are passed in as arguments.
+        names = self._compiled("lookup_names",self._lookup_names)
+        outer = tuple(sorted(nm for nm in names if nm in f_locals))
+        key = (run_in,type(self),outer)
+        code = self._compiled(key,lambda: self._compile_block(outer,"<run_in>",
+                                                              return_locals=True))
+        stored = self._compiled("store_names",lambda: _store_names(self.bytecode))
+        func = PortableFunction(types.FunctionType(code,frame.f_globals,
+                                                   "<run_in>"))
+        future = self.__executor.submit(func,*[f_locals[nm] for nm in outer])
+        from withhacks._futures import BlockFuture
+        self.future = BlockFuture(future,frame,stored,self._as_target_name())
+        self._run_as_clause(self.future)
+        self._release_bytecode()
+        return retcode
+
+
+class parallel_map(CaptureBytecode):
+    """WithHack applying the block to each item of an iterable, in parallel.
+
+    The block is not executed in place.  Instead it becomes a function of
+    a single argument, named by "arg", which is mapped over "items" using an
+    executor.  The "as" variable is bound to an iterator over the values
+    returned by the block, in the same order as the items:
+
+        >>> def squares(items,offset):
+        ...     with parallel_map(items,arg="n",workers=2) as results:
+        ...         return n * n + offset
+        ...     return list(results)
+        ...
+        >>> squares(range(5),1)
+        [1, 2, 5, 10, 17]
+
+    Results are yielded as they become available.  The items are sent to the
+    workers a chunk at a time, and only a couple of chunks per worker are
+    in flight at once; more items are read from the iterable as results are
+    consumed, so large or unbounded iterables can be streamed through.  The
+    following arguments control how the work is done:
+
+        * workers:    number of worker threads or processes
+        * chunksize:  number of items sent to a worker at once
+        * processes:  boolean indicating the use of processes, not threads
+        * executor:   an existing executor to use instead of a new pool
+
+    If the results aren't all consumed, chunks that haven't started yet are
+    cancelled when the iterator is closed.
+
+    As with run_in(), the block sees the values that local variables of the
+    enclosing frame had when it was submitted.  When using processes, those
+    values and the results must be picklable.  Variables assigned in the
+    block are local to each call, and are not written back.
+    """
+
+    __slots__ = ("__items","__arg","__workers","__chunksize","__processes",
+                 "__executor","results")
+    keep_bytecode = False
+
+    def __init__(self,items,arg="item",workers=None,chunksize=1,
+                      processes=False,executor=None):
+        self.__items = items
+        self.__arg = arg
+        self.__workers = workers
+        self.__chunksize = chunksize
+        self.__processes = processes
+        self.__executor = executor
+        super(parallel_map,self).__init__()
+
+    def __exit__(self,*args):
+        frame = self._get_context_frame()
+        retcode = super(parallel_map,self).__exit__(*args)
+        f_locals = frame.f_locals
+        #  Local variables of the enclosing frame are passed in as arguments,
+        #  ahead of the item itself.
+        arg = self.__arg
+        names = self._compiled("lookup_names",self._lookup_names)
+        outer = tuple(sorted(nm for nm in names if nm in f_locals and nm != arg))
+        key = (parallel_map,type(self),outer,arg)
+        code = self._compiled(key,lambda: self._compile_block(outer + (arg,),
+                                                              "<parallel_map>"))
+        func = PortableFunction(types.FunctionType(code,frame.f_globals,
+                                                   "<parallel_map>"))
+        if outer:
+            func = functools.partial(func,*[f_locals[nm] for nm in outer])
+        executor = self.__executor
+        workers = self.__workers
+        owned = executor is None
+        if owned:
+            from concurrent import futures
+            if self.__processes:
+                executor = futures.ProcessPoolExecutor(workers)
+            else:
+                workers = workers or 4
+                executor = futures.ThreadPoolExecutor(workers)
+        if not workers:
+            import os
+            workers = os.cpu_count() or 1
+        self.results = _map_in_chunks(executor,func,self.__items,
+                                      self.__chunksize,2 * workers,owned)
+        self._run_as_clause(self.results)
+        self._release_bytecode()
+        return retcode
+
+
+def _map_in_chunks(executor,func,items,chunksize,window,owned=False):
+    """Map a function over items with an executor, a chunk at a time.
+
+    At most "window" chunks are pending at once, and the first of them are
+    submitted straight away.  An iterator over the results, in the same
+    order as the items, is returned.  If "owned" is true the executor is
+    shut down once the results are exhausted or the iterator is closed.
+    """
+    items = iter(items)
+    pending = collections.deque()
+    def submit():
+        chunk = list(itertools.islice(items,chunksize))
+        if chunk:
+            pending.append(executor.submit(_apply_chunk,func,chunk))
+    try:
+        for _ in range(window):
+            submit()
+    except BaseException:
+        _cancel_chunks(pending,executor if owned else None)
+        raise
+    return _iter_chunk_results(pending,submit,executor if owned else None)
+
+
+def _iter_chunk_results(pending,submit,owned):
+    """Yield the results of pending chunks in order, topping up the window."""
+    try:
+        while pending:
+            results = pending.popleft().result()
+            submit()
+            for result in results:
+                yield result
+    finally:
+        _cancel_chunks(pending,owned)
+
+
+def _cancel_chunks(pending,owned):
+    """Cancel pending chunks, and shut down the executor if we own it."""
+    for future in pending:
+        future.cancel()
+    pending.clear()
+    if owned is not None:
+        #  Chunks that have already started still run to completion.
+        owned.shutdown(wait=False)
+
+
+def _apply_chunk(func,chunk):
+    """Apply a function to each item of a chunk, in a worker."""
+    return [func(item) for item in chunk]
+
+
+def precompile(obj):
+    """Prepare the with-statements that use hacks in the given object.
+
+    The object may be a module, a class, a function or a code object.  Its
+    code, including any nested functions, is scanned for with-statements
+    whose context expression is a WithHack subclass (or an instance of one)
+    named by a global variable, possibly followed by attribute lookups.
+    Each of them has its bytecode captured and cached, along with anything
+    that its hack can compile without running the block, just as if it had
+    already been executed.  Calling this at startup, before forking worker
+    processes, means that no request pays the cost of the first execution.
+
+        >>> def f():
+        ...     with namespace() as ns:
+        ...         x = 1
+        ...     return ns.x
+        ...
+        >>> precompile(f)
+        1
+        >>> f()
+        1
+
+    The number of with-statements prepared is returned.  Code that runs at
+    the top level of a module can't be found, since a module doesn't keep
+    its code object once it has been imported.
+    """
+    count = 0
+    for (code,globals) in _iter_codes(obj):
+        try:
+            (_,blocks) = index_with_blocks(code)
+        except Exception:
+            continue
+        if not blocks:
+            continue
+        instrs = list(_dis.get_instructions(code))
+        for start in sorted(blocks):
+            cls = _find_hack_class(instrs,start,globals)
+            if cls is None or not hasattr(cls,"_precompile"):
+                continue
+            site = _get_call_site(code,start)
+            if site is not None:
+                cls._precompile(site)
+                count += 1
+    return count
+
+
+def _iter_codes(obj,seen=None):
+    """Iterate over (code,globals) for all the code in the given object."""
+    if seen is None:
+        seen = set()
+    if isinstance(obj,types.ModuleType):
+        for value in list(vars(obj).values()):
+            if getattr(value,"__module__",None) == obj.__name__:
+                yield from _iter_codes(value,seen)
+        return
+    if isinstance(obj,type):
+        if id(obj) in seen:
+            return
+        seen.add(id(obj))
+        for value in list(vars(obj).values()):
+            if isinstance(value,property):
+                for func in (value.fget,value.fset,value.fdel):
+                    if func is not None:
+                        yield from _iter_codes(func,seen)
+            elif isinstance(value,(staticmethod,classmethod,type,
+                                   types.FunctionType)):
+                yield from _iter_codes(value,seen)
+        return
+    if isinstance(obj,(staticmethod,classmethod)):
+        obj = obj.__func__
+    while isinstance(obj,types.FunctionType):
+        globals = obj.__globals__
+        yield from _iter_code_consts(obj.__code__,globals,seen)
+        obj = getattr(obj,"__wrapped__",None)
+    if isinstance(obj,types.CodeType):
+        yield from _iter_code_consts(obj,{},seen)
+
+
+def _iter_code_consts(code,globals,seen):
+    """Iterate over (code,globals) for a code object and those nested in it."""
+    if id(code) in seen:
+        return
+    seen.add(id(code))
+    yield (code,globals)
+    for const in code.co_consts:
+        if isinstance(const,types.CodeType):
+            yield from _iter_code_consts(const,globals,seen)
+
+
+def _find_hack_class(instrs,start,globals):
+    """Find the WithHack class used by the with-statement at offset "start".
+
+    The context expression is found by working back from the instruction
+    that enters the with-statement until it accounts for a single value on
+    the stack.  None is returned if it isn't a global name, or attributes
+    looked up on one, that refers to a WithHack class or instance.
+    """
+    for (i,instr) in enumerate(instrs):
+        if instr.offset == start:
+            break
+    else:
+        return None
+    if instr.opname != "SETUP_WITH":
+        #  An "async with" awaits __aenter__ first; skip back over that.
+        while i > 0 and instrs[i].opname != "BEFORE_ASYNC_WITH":
+            i -= 1
+    depth = 0
+    for j in range(i-1,-1,-1):
+        op = instrs[j]
+        try:
+            arg = op.arg if op.opcode >= _dis.HAVE_ARGUMENT else None
+            depth += _dis.stack_effect(op.opcode,arg)
+        except ValueError:
+            return None
+        if depth == 1:
+            break
+    else:
+        return None
+    first = instrs[j]
+    if first.opname not in ("LOAD_GLOBAL","LOAD_NAME"):
+        return None
+    try:
+        obj = globals[first.argval]
+    except KeyError:
+        builtins = globals.get("__builtins__",{})
+        if isinstance(builtins,types.ModuleType):
+            builtins = vars(builtins)
+        obj = builtins.get(first.argval)
+    for op in instrs[j+1:i]:
+        if op.opname not in ("LOAD_ATTR","LOAD_METHOD"):
+            break
+        #  Only look inside modules and classes, to avoid running any code.
+        if not isinstance(obj,(types.ModuleType,type)):
+            return None
+        obj = getattr(obj,op.argval,None)
+    if isinstance(obj,type) and issubclass(obj,WithHack):
+        return obj
+    if isinstance(obj,WithHack):
+        return type(obj)
+    return None
@@ -0,0 +1,77 @@
+"""
+
+  withhacks._futures:  futures for blocks run in the background by run_in()
+
+This lives apart from the rest of withhacks so that concurrent.futures, which
+is slow to import, is only imported once run_in() is first used.
+
+"""
+
+import sys
+import weakref
+from concurrent import futures
+
+from withhacks.frameutils import update_locals
+
+
+class BlockFuture(futures.Future):
+    """Future for a with-statement block running in the background.
+
+    This is a real concurrent.futures.Future, so it can be passed to wait()
+    and as_completed().  It's completed from the future returned by the
+    executor, whose result is the block's return value along with its local
+    variables.  The variables assigned in the block are available as the
+    attribute "locals" once it has finished.
+
+    When the result is first collected, those variables are also written
+    back into the frame that contained the with-statement, provided that
+    frame is still running in the collecting thread.  The frame is only
+    identified by its id and code object rather than referenced, so that
+    the future doesn't keep it alive.  Since frames are reused for later
+    calls of the same code, it must also still have the future bound to
+    the variable named by "target"; if that's None nothing is written back.
+    """
+
+    def __init__(self,future,frame,names,target=None):
+        super(BlockFuture,self).__init__()
+        self.__future = future
+        self.__frame_id = id(frame)
+        self.__frame_code = weakref.ref(frame.f_code)
+        self.__names = names
+        self.__target = target
+        self.locals = None
+        future.add_done_callback(self.__complete)
+
+    def __complete(self,future):
+        if future.cancelled():
+            super(BlockFuture,self).cancel()
+            return
+        exc = future.exception()
+        if exc is not None:
+            self.set_exception(exc)
+            return
+        (retval,locals) = future.result()
+        self.locals = {nm: locals[nm] for nm in self.__names if nm in locals}
+        self.set_result(retval)
+
+    def cancel(self):
+        #  If the executor's future is cancelled, so is this one.
+        return self.__future.cancel()
+
+    def running(self):
+        return not self.done() and self.__future.running()
+
+    def result(self,timeout=None):
+        retval = super(BlockFuture,self).result(timeout)
+        code = self.__frame_code
+        if code is not None:
+            self.__frame_code = None
+            code = code()
+            f = sys._getframe(1)
+            while f is not None and not (id(f) == self.__frame_id and
+                                         f.f_code is code):
+                f = f.f_back
+            if f is not None and self.locals and self.__target is not None:
+                if f.f_locals.get(self.__target) is self:
+                    update_locals(f,self.locals)
+        return retval
@@ -0,0 +1,40 @@
+"""
+
+  withhacks._lazy:  deferred import of modules that are slow to import
+
+Most of withhacks' machinery needs the "bytecode" library and some of the
+heavier parts of the standard library, but skipping a block or capturing
+its locals doesn't.  Modules that hold a LazyModule in place of such a
+module only import it when one of its attributes is first used.
+
+"""
+
+import sys
+
+
+class LazyModule(object):
+    """Stand-in for a module that is imported on first attribute access.
+
+    The stand-in is created with the name of the module and the globals
+    dict it's stored in.  When the module is imported the stand-in replaces
+    itself there with the real module, so later lookups cost nothing extra.
+    """
+
+    __slots__ = ("__name","__namespace")
+
+    def __init__(self,name,namespace):
+        self.__name = name
+        self.__namespace = namespace
+
+    def __getattr__(self,attr):
+        name = self.__name
+        __import__(name)
+        module = sys.modules[name]
+        namespace = self.__namespace
+        for (key,value) in list(namespace.items()):
+            if value is self:
+                namespace[key] = module
+        return getattr(module,attr)
+
+    def __repr__(self):
+        return "<lazy module %r>" % (self.__name,)
@@ -0,0 +1,409 @@
+"""
+
+  withhacks.benchmarks:  timing the hacks against equivalent plain code
+
+This package measures what each of the hacks in withhacks costs, comparing
+each with-statement against hand-written code that does the same thing.
+The benchmarks are grouped as follows:
+
+  :latency:     cost of entering and exiting each hack with a tiny block
+  :iteration:   cost of each iteration of a loop inside the block
+  :func_size:   scaling with the size of the enclosing function
+  :block_size:  scaling with the size of the block itself
+  :frameutils:  cost of the primitives in withhacks.frameutils
+
+Run them from the command line, optionally saving the results as JSON so
+that they can be compared across releases:
+
+    $ python -m withhacks.benchmarks --json results.json
+
+Or from python, where run() returns the results as a list of dicts:
+
+    >>> from withhacks import benchmarks
+    >>> results = benchmarks.run(["namespace"], number=10, repeat=1)
+    >>> sorted(results[0])
+    ['group', 'name', 'param', 'timings']
+    >>> sorted(results[0]["timings"])
+    ['baseline', 'hack']
+
+Each timing is the best seconds-per-call over the repeats, except in the
+iteration group where it's the best seconds per iteration of the loop.
+
+"""
+
+import sys
+import time
+import timeit
+import platform
+
+import withhacks
+from withhacks import *
+from withhacks import frameutils
+
+
+__all__ = ["run","metadata","BENCHMARKS"]
+
+#  List of (group,name,function) for every benchmark.  Each function returns
+#  a list of (param,{variant: callable}) cases to time.
+BENCHMARKS = []
+
+#  Parameters for the scaling benchmarks.
+SIZES = (10,100,1000)
+
+
+def benchmark(group,name=None):
+    """Decorator registering a function as a benchmark in the given group."""
+    def register(func):
+        BENCHMARKS.append((group,name or func.__name__,func))
+        return func
+    return register
+
+
+def run(names=None,number=1000,repeat=5):
+    """Run the benchmarks, returning a list of results.
+
+    If "names" is given, only benchmarks whose name or group is in it are
+    run.  Each result is a dict with keys "group", "name", "param" and
+    "timings", the last mapping each variant to its best time per call,
+    or per loop iteration for the iteration group.  The "baseline" variant
+    is the equivalent hand-written code.
+    """
+    results = []
+    for (group,name,cases) in BENCHMARKS:
+        if names and name not in names and group not in names:
+            continue
+        for (param,variants) in cases():
+            timings = {}
+            for (variant,func) in variants.items():
+                n = number
+                if param is not None and group != "frameutils":
+                    n = max(1,number // param)
+                #  Each call of an iteration benchmark runs "param" loops.
+                per_call = param if group == "iteration" else 1
+                timer = timeit.Timer(func)
+                timings[variant] = min(timer.repeat(repeat,n)) / (n * per_call)
+            results.append({"group": group,"name": name,"param": param,
+                            "timings": timings})
+    return results
+
+
+def metadata():
+    """Get a dict describing the environment the benchmarks were run in."""
+    try:
+        import bytecode
+        bytecode_version = bytecode.__version__
+    except (ImportError,AttributeError):
+        bytecode_version = None
+    return {"withhacks": withhacks.__version__,
+            "bytecode": bytecode_version,
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%SZ",time.gmtime())}
+
+
+def _generate(name,lines,ns=None):
+    """Generate a function from the given lines of source code."""
+    ns = dict(globals(),**(ns or {}))
+    exec("\n".join(lines),ns)
+    return ns[name]
+
+
+class _Target(object):
+    """Target object for namespace benchmarks."""
+    pass
+
+
+def _call(*args,**kwds):
+    return args
+
+
+def _noop(frame):
+    pass
+
+
+#  Entry/exit latency of each hack, with a tiny block.
+
+def _namespace_hack():
+    with namespace() as ns:
+        x = 1
+        y = x + 1
+    return ns
+
+def _namespace_plain():
+    ns = _Target()
+    ns.x = 1
+    ns.y = ns.x + 1
+    return ns
+
+def _keyspace_hack():
+    with keyspace() as ks:
+        x = 1
+        y = x + 1
+    return ks
+
+def _keyspace_plain():
+    ks = {}
+    ks["x"] = 1
+    ks["y"] = ks["x"] + 1
+    return ks
+
+def _xargs_hack():
+    with xargs(_call,0) as result:
+        a = 1
+        b = 2
+    return result
+
+def _xargs_plain():
+    a = 1
+    b = 2
+    result = _call(0,a,b)
+    return result
+
+def _xkwargs_hack():
+    with xkwargs(_call,c=0) as result:
+        a = 1
+        b = 2
+    return result
+
+def _xkwargs_plain():
+    a = 1
+    b = 2
+    result = _call(c=0,a=a,b=b)
+    return result
+
+def _capturefunction_hack():
+    with CaptureFunction(("a",)) as c:
+        return a + 1
+    return c.function
+
+def _capturefunction_plain():
+    def function(a):
+        return a + 1
+    return function
+
+def _capturelocals_hack():
+    with CaptureLocals() as c:
+        x = 1
+        y = 2
+    return c.locals
+
+def _capturelocals_plain():
+    x = 1
+    y = 2
+    return {"x": x,"y": y}
+
+def _capturemodifiedlocals_hack():
+    with CaptureModifiedLocals() as c:
+        x = 1
+        y = 2
+    return c.locals
+
+_capturemodifiedlocals_plain = _capturelocals_plain
+
+
+def _latency(name):
+    hack = globals()["_%s_hack" % (name.lower(),)]
+    plain = globals()["_%s_plain" % (name.lower(),)]
+    @benchmark("latency",name)
+    def cases():
+        return [(None,{"hack": hack,"baseline": plain})]
+
+for _name in ("namespace","keyspace","xargs","xkwargs","CaptureFunction",
+              "CaptureLocals","CaptureModifiedLocals"):
+    _latency(_name)
+del _name
+
+
+#  Per-iteration cost of code inside the block.
+
+def _namespace_loop(n):
+    with namespace() as ns:
+        total = 0
+        for i in range(n):
+            total = total + len((i,))
+    return ns
+
+def _namespace_loop_plain(n):
+    ns = _Target()
+    ns.total = 0
+    for ns.i in range(n):
+        ns.total = ns.total + len((ns.i,))
+    return ns
+
+def _keyspace_loop(n):
+    with keyspace() as ks:
+        total = 0
+        for i in range(n):
+            total = total + len((i,))
+    return ks
+
+def _keyspace_loop_plain(n):
+    ks = {}
+    ks["total"] = 0
+    for ks["i"] in range(n):
+        ks["total"] = ks["total"] + len((ks["i"],))
+    return ks
+
+def _locals_loop(n):
+    with CaptureLocals() as c:
+        total = 0
+        for i in range(n):
+            total = total + len((i,))
+    return c.locals
+
+def _locals_loop_plain(n):
+    total = 0
+    for i in range(n):
+        total = total + len((i,))
+    return {"total": total,"i": i}
+
+
+@benchmark("iteration","namespace")
+def _namespace_iteration():
+    return [(n,{"hack": lambda n=n: _namespace_loop(n),
+                "baseline": lambda n=n: _namespace_loop_plain(n)})
+            for n in SIZES]
+
+
+@benchmark("iteration","keyspace")
+def _keyspace_iteration():
+    return [(n,{"hack": lambda n=n: _keyspace_loop(n),
+                "baseline": lambda n=n: _keyspace_loop_plain(n)})
+            for n in SIZES]
+
+
+@benchmark("iteration","CaptureLocals")
+def _locals_iteration():
+    return [(n,{"hack": lambda n=n: _locals_loop(n),
+                "baseline": lambda n=n: _locals_loop_plain(n)})
+            for n in SIZES]
+
+
+#  Scaling with the size of the enclosing function and of the block.
+
+def _sized_function(hack,size):
+    lines = ["def func():"]
+    lines.extend("    a%d = %d" % (i,i) for i in range(size))
+    lines.append("    with %s() as c:" % (hack.__name__,))
+    lines.append("        x = 1")
+    lines.append("    return c")
+    return _generate("func",lines,{hack.__name__: hack})
+
+
+class _UncachedLocals(CaptureLocals):
+    cache_bytecode = False
+
+
+@benchmark("func_size","CaptureLocals")
+def _locals_func_size():
+    cases = []
+    for n in SIZES:
+        baseline = _generate("func",["def func():"] +
+                             ["    a%d = %d" % (i,i) for i in range(n)] +
+                             ["    x = 1","    return {'x': x}"])
+        cases.append((n,{"hack": _sized_function(CaptureLocals,n),
+                         "uncached": _sized_function(_UncachedLocals,n),
+                         "baseline": baseline}))
+    return cases
+
+
+class _AssignedOnlyLocals(CaptureModifiedLocals):
+    def __init__(self):
+        super(_AssignedOnlyLocals,self).__init__(assigned_only=True)
+
+
+@benchmark("func_size","CaptureModifiedLocals")
+def _modified_locals_func_size():
+    cases = []
+    for n in SIZES:
+        baseline = _generate("func",["def func():"] +
+                             ["    a%d = %d" % (i,i) for i in range(n)] +
+                             ["    x = 1","    return {'x': x}"])
+        cases.append((n,{"hack": _sized_function(CaptureModifiedLocals,n),
+                         "assigned_only": _sized_function(_AssignedOnlyLocals,n),
+                         "baseline": baseline}))
+    return cases
+
+
+@benchmark("func_size","namespace")
+def _namespace_func_size():
+    cases = []
+    for n in SIZES:
+        baseline = _generate("func",["def func():"] +
+                             ["    a%d = %d" % (i,i) for i in range(n)] +
+                             ["    c = _Target()","    c.x = 1","    return c"])
+        cases.append((n,{"hack": _sized_function(namespace,n),
+                         "baseline": baseline}))
+    return cases
+
+
+@benchmark("block_size","namespace")
+def _namespace_block_size():
+    cases = []
+    for n in SIZES:
+        hack = _generate("func",["def func():","    with namespace() as c:"] +
+                         ["        x%d = %d" % (i,i) for i in range(n)] +
+                         ["    return c"])
+        baseline = _generate("func",["def func():","    c = _Target()"] +
+                             ["    c.x%d = %d" % (i,i) for i in range(n)] +
+                             ["    return c"])
+        cases.append((n,{"hack": hack,"baseline": baseline}))
+    return cases
+
+
+@benchmark("block_size","CaptureFunction")
+def _function_block_size():
+    cases = []
+    for n in SIZES:
+        hack = _generate("func",["def func():",
+                                 "    with CaptureFunction(('a',)) as c:"] +
+                         ["        x%d = a" % (i,) for i in range(n)] +
+                         ["    return c.function"])
+        baseline = _generate("func",["def func():","    def function(a):"] +
+                             ["        x%d = a" % (i,) for i in range(n)] +
+                             ["    return function"])
+        cases.append((n,{"hack": hack,"baseline": baseline}))
+    return cases
+
+
+#  The primitives in frameutils.
+
+def _inject():
+    frameutils.inject_trace_func(sys._getframe(),_noop)
+    return None
+
+def _inject_plain():
+    _noop(sys._getframe())
+    return None
+
+
+@benchmark("frameutils","inject_trace_func")
+def _inject_trace_func():
+    return [(None,{"hack": _inject,"baseline": _inject_plain})]
+
+
+@benchmark("frameutils","extract_code")
+def _extract_code():
+    cases = []
+    for n in SIZES:
+        func = _generate("func",["def func():"] +
+                         ["    a%d = %d" % (i,i) for i in range(n)] +
+                         ["    return sys._getframe()"])
+        frame = func()
+        cases.append((n,{"hack": lambda frame=frame: frameutils.extract_code(frame)}))
+    return cases
+
+
+@benchmark("frameutils","index_with_blocks")
+def _index_with_blocks():
+    cases = []
+    for n in SIZES:
+        func = _sized_function(CaptureLocals,n)
+        def index(code=func.__code__):
+            frameutils._with_block_index.pop(code,None)
+            return frameutils.index_with_blocks(code)
+        cases.append((n,{"hack": index,
+                         "cached": lambda code=func.__code__:
+                                       frameutils.index_with_blocks(code)}))
+    return cases
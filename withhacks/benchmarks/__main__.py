@@ -0,0 +1,51 @@
+"""
+
+  withhacks.benchmarks.__main__:  command-line interface to the benchmarks
+
+"""
+
+import sys
+import json
+import argparse
+
+from withhacks import benchmarks
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m withhacks.benchmarks",
+                                     description="Time the withhacks hacks.")
+    parser.add_argument("names",nargs="*",
+                        help="names or groups of benchmarks to run")
+    parser.add_argument("--number",type=int,default=1000,
+                        help="calls per timing (default: %(default)s)")
+    parser.add_argument("--repeat",type=int,default=5,
+                        help="timings per benchmark (default: %(default)s)")
+    parser.add_argument("--json",metavar="FILE",
+                        help="write the results as JSON to FILE ('-' for stdout)")
+    args = parser.parse_args(argv)
+
+    results = benchmarks.run(args.names,number=args.number,repeat=args.repeat)
+    if args.json:
+        data = {"metadata": benchmarks.metadata(),"results": results}
+        if args.json == "-":
+            json.dump(data,sys.stdout,indent=2,sort_keys=True)
+            sys.stdout.write("\n")
+        else:
+            with open(args.json,"w") as f:
+                json.dump(data,f,indent=2,sort_keys=True)
+        return 0
+
+    for result in results:
+        label = "%s/%s" % (result["group"],result["name"])
+        if result["param"] is not None:
+            label += "[%d]" % (result["param"],)
+        timings = result["timings"]
+        parts = ["%s=%.2fus" % (v,t * 1e6) for (v,t) in sorted(timings.items())]
+        if "baseline" in timings and "hack" in timings:
+            parts.append("x%.1f" % (timings["hack"] / timings["baseline"],))
+        print("%-40s %s" % (label,"  ".join(parts)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,163 @@
+"""
+
+  withhacks.diskcache:  on-disk cache of the code compiled by the hacks
+
+Each process normally compiles the code for a with-statement the first time
+it's executed, by rewriting the captured bytecode and assembling it into a
+new code object.  Processes that start often, such as the workers of a
+prefork server, can instead share the results through a cache directory
+much like __pycache__.  It's enabled by setting the WITHHACKS_CACHE_DIR
+environment variable, or by calling set_cache_dir():
+
+    >>> import tempfile, withhacks
+    >>> withhacks.set_cache_dir(tempfile.mkdtemp())
+    >>> with withhacks.namespace() as ns:
+    ...     x = 1
+    ...
+    >>> len(os.listdir(withhacks.get_cache_dir()))
+    1
+    >>> withhacks.set_cache_dir(None)
+
+Each cache file holds a single marshalled code object.  Its name is a hash
+of the enclosing code object, the offset of the with-statement within it,
+the hack class and its compilation settings, and the versions of python,
+the bytecode library and withhacks, so stale entries are never used.
+Files are written atomically, so processes can share the directory freely.
+Code that can't be marshalled is simply not cached.
+
+"""
+
+import os
+import sys
+import types
+import marshal
+
+from withhacks.__about__ import __version__
+
+
+__all__ = ["set_cache_dir","get_cache_dir"]
+
+_cache_dir = os.environ.get("WITHHACKS_CACHE_DIR") or None
+
+#  Versions that the compiled code depends on, worked out on first use.
+_version_tag = None
+
+
+def set_cache_dir(path):
+    """Set the directory to cache compiled code in, or None to disable it.
+
+    The directory is created if it doesn't already exist.
+    """
+    global _cache_dir
+    if path is not None:
+        os.makedirs(path,exist_ok=True)
+    _cache_dir = path
+
+
+def get_cache_dir():
+    """Get the directory compiled code is cached in, or None if disabled."""
+    return _cache_dir
+
+
+def cache_path(code,start,key):
+    """Get the cache file for code compiled from the given call site.
+
+    "code" and "start" identify the with-statement, and "key" is the key
+    that the hack compiled the code under; only tuple keys are cached.  None
+    is returned if caching is disabled or the key or code can't be
+    identified across processes.
+    """
+    cache_dir = _cache_dir
+    if cache_dir is None or not isinstance(key,tuple):
+        return None
+    key = _key_string(key)
+    if key is None:
+        return None
+    try:
+        source = marshal.dumps(code)
+    except ValueError:
+        return None
+    import hashlib
+    digest = hashlib.sha1(source)
+    digest.update(("\0%d\0%s\0%s" % (start,key,_get_version_tag())).encode("utf8"))
+    return os.path.join(cache_dir,digest.hexdigest() + ".code")
+
+
+def load(path):
+    """Load a cached code object, returning None if there isn't one."""
+    try:
+        with open(path,"rb") as f:
+            data = f.read()
+    except OSError:
+        return None
+    try:
+        code = marshal.loads(data)
+    except (ValueError,EOFError,TypeError):
+        return None
+    if not isinstance(code,types.CodeType):
+        return None
+    return code
+
+
+def store(path,code):
+    """Store a code object in the cache, if it can be marshalled.
+
+    The file is written under a temporary name and then renamed, so other
+    processes never see it half-written.  Failures are silently ignored.
+    """
+    if not isinstance(code,types.CodeType):
+        return
+    try:
+        data = marshal.dumps(code)
+    except ValueError:
+        return
+    import tempfile
+    dirname = os.path.dirname(path)
+    try:
+        (fd,tmppath) = tempfile.mkstemp(dir=dirname,suffix=".tmp")
+    except OSError:
+        return
+    try:
+        with os.fdopen(fd,"wb") as f:
+            f.write(data)
+        os.replace(tmppath,path)
+    except OSError:
+        try:
+            os.unlink(tmppath)
+        except OSError:
+            pass
+
+
+def _get_version_tag():
+    """Get a string identifying the versions the compiled code depends on."""
+    global _version_tag
+    if _version_tag is None:
+        import bytecode
+        _version_tag = "%s-%s-%s-%s" % (sys.implementation.cache_tag,
+                                        marshal.version,
+                                        getattr(bytecode,"__version__","unknown"),
+                                        __version__)
+    return _version_tag
+
+
+def _key_string(key):
+    """Get a string identifying a compilation key across processes.
+
+    Keys are tuples or frozensets of classes and simple values; None is
+    returned for anything else.
+    """
+    if isinstance(key,type):
+        return "%s.%s" % (key.__module__,key.__qualname__)
+    if key is None or isinstance(key,(str,int,bool)):
+        return repr(key)
+    if isinstance(key,tuple):
+        parts = [_key_string(item) for item in key]
+        if None in parts:
+            return None
+        return "(%s)" % (",".join(parts),)
+    if isinstance(key,frozenset):
+        parts = [_key_string(item) for item in key]
+        if None in parts:
+            return None
+        return "{%s}" % (",".join(sorted(parts)),)
+    return None
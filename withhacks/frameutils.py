@@ -7,23 +7,136 @@
 from __future__ import with_statement
 
 import sys
-import dis
 import types
-try:
-    import threading
-except ImportError:
-    import dummy_threading as threading
+import weakref
+#  The primitives behind threading.Lock and threading.local, without the
+#  cost of importing threading itself.
+import _thread
 
-from bytecode import Bytecode, ConcreteBytecode, dump_bytecode
-import bytecode
+from withhacks._lazy import LazyModule
 
+bytecode = LazyModule("bytecode",globals())
 
-__all__ = ["inject_trace_func","extract_code","load_name"]
+#  As defined in inspect, which is slow to import.
+CO_OPTIMIZED = 0x1
 
-_trace_lock = threading.Lock()
-_orig_sys_trace = None
-_orig_trace_funcs = {}
-_injected_trace_funcs = {}
+
+__all__ = ["inject_trace_func","update_locals","extract_code",
+           "index_with_blocks","load_name"]
+
+class _CodeDict(object):
+    """Dict mapping code objects to values, holding the code objects weakly.
+
+    This is like a WeakKeyDictionary, but entries are keyed on id(code) so
+    that lookups never hash the code object.  Hashing a code object hashes
+    all of its constants, including any nested code objects, so it costs
+    more the bigger the function is.  Each entry is removed when its code
+    object goes away.
+    """
+
+    __slots__ = ("__data",)
+
+    def __init__(self):
+        self.__data = {}
+
+    def __getitem__(self,code):
+        (ref,value) = self.__data[id(code)]
+        if ref() is not code:
+            raise KeyError(code)
+        return value
+
+    def get(self,code,default=None):
+        try:
+            return self[code]
+        except KeyError:
+            return default
+
+    def __contains__(self,code):
+        try:
+            self[code]
+        except KeyError:
+            return False
+        return True
+
+    def __setitem__(self,code,value):
+        key = id(code)
+        data = self.__data
+        def remove(ref):
+            entry = data.get(key)
+            if entry is not None and entry[0] is ref:
+                del data[key]
+        data[key] = (weakref.ref(code,remove),value)
+
+    def __delitem__(self,code):
+        self[code]
+        del self.__data[id(code)]
+
+    def setdefault(self,code,default=None):
+        try:
+            return self[code]
+        except KeyError:
+            self[code] = default
+            return default
+
+    def pop(self,code,*default):
+        try:
+            value = self[code]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        del self.__data[id(code)]
+        return value
+
+    def clear(self):
+        self.__data.clear()
+
+    def __len__(self):
+        return len(self.__data)
+
+
+#  On Python 3.12 and later, injected functions are run from a sys.monitoring
+#  (PEP 669) callback that is only enabled for the code objects of frames
+#  with pending functions.  Set this to False to force use of sys.settrace.
+use_monitoring = hasattr(sys,"monitoring")
+_monitoring_tool = None
+_monitoring_tool_lock = _thread.allocate_lock()
+
+#  Number of frames waiting on each instrumented code object, guarded by
+#  one of a small set of locks picked by the code object's id.
+_monitored_codes = _CodeDict()
+_monitored_code_locks = [_thread.allocate_lock() for _ in range(16)]
+
+#  Optional pair of functions (on_inject,on_invoke) used by withhacks.stats
+#  to time how long tracing is active.  The value returned by on_inject() is
+#  passed to on_invoke() once the injected functions are run.
+_trace_hooks = None
+
+
+class _ThreadState(_thread._local):
+    """Per-thread record of frames waiting on injected trace functions.
+
+    sys.settrace is itself per-thread, so each thread switches tracing on
+    and off independently of the others.
+    """
+    def __init__(self):
+        self.num_frames = 0
+        self.orig_sys_trace = None
+
+_thread_state = _ThreadState()
+
+
+def _check_locals_write_through():
+    """Check whether writes to frame.f_locals go straight to the frame.
+
+    This is the case from Python 3.13 onwards, where f_locals is a proxy
+    for the frame's local variables (PEP 667).
+    """
+    x = False
+    sys._getframe().f_locals["x"] = True
+    return x
+
+_locals_write_through = _check_locals_write_through()
 
 
 def _dummy_sys_trace(*args,**kwds):
@@ -32,56 +145,176 @@ def _dummy_sys_trace(*args,**kwds):
 
 
 def _enable_tracing():
-    """Enable system-wide tracing, if it wasn't already."""
-    global _orig_sys_trace
-    try:
-        _orig_sys_trace = sys.gettrace()
-    except AttributeError:
-        _orig_sys_trace = None
-    if _orig_sys_trace is None:
-        sys.settrace(_dummy_sys_trace)
+    """Enable tracing in the current thread, if it wasn't already."""
+    state = _thread_state
+    if not state.num_frames:
+        try:
+            state.orig_sys_trace = sys.gettrace()
+        except AttributeError:
+            state.orig_sys_trace = None
+        if state.orig_sys_trace is None:
+            sys.settrace(_dummy_sys_trace)
+    state.num_frames += 1
 
 
 def _disable_tracing():
-    """Disable system-wide tracing, if we specifically switched it on."""
-    global _orig_sys_trace
-    if _orig_sys_trace is None:
+    """Disable tracing in the current thread, if we specifically switched it on."""
+    state = _thread_state
+    state.num_frames -= 1
+    if not state.num_frames and state.orig_sys_trace is None:
         sys.settrace(None)
 
 
+class _TraceInjector(object):
+    """Trace function holding the functions injected into a single frame.
+
+    An instance is installed as the frame's f_trace, so the pending functions
+    are stored on the frame itself and go away with it.  Once they have been
+    run the frame's original trace function is put back.
+    """
+
+    __slots__ = ("orig_trace","funcs","code","token")
+
+    def __init__(self,orig_trace,code=None):
+        self.orig_trace = orig_trace
+        self.funcs = []
+        #  The instrumented code object, if sys.monitoring is in use.
+        self.code = code
+        hooks = _trace_hooks
+        self.token = hooks[0]() if hooks is not None else None
+
+    def __call__(self,frame,*args,**kwds):
+        self.invoke(frame)
+
+    def invoke(self,frame):
+        """Invoke the injected functions and remove the trace hooks.
+
+        Hopefully this will keep the overhead of all this madness to a
+        minimum :-)
+        """
+        frame.f_trace = self.orig_trace
+        if self.code is None:
+            _disable_tracing()
+        else:
+            _release_monitored_code(self.code)
+        hooks = _trace_hooks
+        if hooks is not None and self.token is not None:
+            hooks[1](self.token)
+        for func in self.funcs:
+            func(frame)
+
+
 def inject_trace_func(frame,func):
     """Inject the given function as a trace function for frame.
 
     The given function will be executed immediately as the frame's execution
     resumes.  Since it's running inside a trace hook, it can do some nasty
     things like modify frame.f_locals, frame.f_lasti and friends.
+
+    Where sys.monitoring is available it is used in place of sys.settrace,
+    so that only the frame's code object is instrumented rather than every
+    frame in the thread.  Changes to frame.f_locals are still written back.
+    """
+    trace = frame.f_trace
+    if not isinstance(trace,_TraceInjector):
+        if use_monitoring and _get_monitoring_tool() is not None:
+            trace = _TraceInjector(trace,frame.f_code)
+            _acquire_monitored_code(frame.f_code)
+        else:
+            trace = _TraceInjector(trace)
+            _enable_tracing()
+        frame.f_trace = trace
+    trace.funcs.append(func)
+
+
+def update_locals(frame,locals):
+    """Update local variables of the given frame.
+
+    If the frame's f_locals can be written to directly, the variables are
+    updated immediately.  Otherwise a trace function is injected to update
+    them as the frame's execution resumes.
+    """
+    if _locals_write_through or not frame.f_code.co_flags & CO_OPTIMIZED:
+        frame.f_locals.update(locals)
+    else:
+        inject_trace_func(frame,lambda frame: frame.f_locals.update(locals))
+
+
+def _get_monitoring_tool():
+    """Get the sys.monitoring tool id used by withhacks, claiming it if needed.
+
+    None is returned if all the candidate tool ids are already in use.
     """
-    with _trace_lock:
-        if frame.f_trace is not _invoke_trace_funcs:
-            _orig_trace_funcs[frame] = frame.f_trace
-            frame.f_trace = _invoke_trace_funcs
-            _injected_trace_funcs[frame] = []
-            if len(_orig_trace_funcs) == 1:
-                _enable_tracing()
-    _injected_trace_funcs[frame].append(func)
-
-
-def _invoke_trace_funcs(frame,*args,**kwds):
-    """Invoke any trace funcs that have been injected.
-
-    Once all injected functions have been executed, the trace hooks are
-    removed.  Hopefully this will keep the overhead of all this madness
-    to a minimum :-)
+    global _monitoring_tool
+    if _monitoring_tool is None:
+        monitoring = sys.monitoring
+        with _monitoring_tool_lock:
+            if _monitoring_tool is None:
+                #  Prefer the ids that have no conventional owner.
+                for tool in (4,3,5):
+                    if monitoring.get_tool(tool) is None:
+                        monitoring.use_tool_id(tool,"withhacks")
+                        monitoring.register_callback(tool,
+                            monitoring.events.INSTRUCTION,
+                            _invoke_monitored_funcs)
+                        _monitoring_tool = tool
+                        break
+    return _monitoring_tool
+
+
+def _acquire_monitored_code(code):
+    """Switch on sys.monitoring events for code, if they weren't already."""
+    with _monitored_code_locks[id(code) % len(_monitored_code_locks)]:
+        num_frames = _monitored_codes.get(code,0)
+        if not num_frames:
+            sys.monitoring.set_local_events(_monitoring_tool,code,
+                sys.monitoring.events.INSTRUCTION)
+        _monitored_codes[code] = num_frames + 1
+
+
+def _release_monitored_code(code):
+    """Switch off sys.monitoring events for code once no frames need them."""
+    with _monitored_code_locks[id(code) % len(_monitored_code_locks)]:
+        num_frames = _monitored_codes[code] - 1
+        if num_frames:
+            _monitored_codes[code] = num_frames
+        else:
+            del _monitored_codes[code]
+            sys.monitoring.set_local_events(_monitoring_tool,code,0)
+
+
+def _invoke_monitored_funcs(code,offset):
+    """sys.monitoring callback to invoke any funcs injected for a frame.
+
+    The callback fires for every frame executing the instrumented code, so
+    frames without injected functions are ignored.
     """
+    frame = sys._getframe(1)
+    trace = frame.f_trace
+    if not isinstance(trace,_TraceInjector) or trace.code is not code:
+        return
+    if not _locals_write_through:
+        #  Refresh the f_locals snapshot, or the write-back below would put
+        #  back values from whenever it was last taken.
+        frame.f_locals
     try:
-        for func in _injected_trace_funcs[frame]:
-            func(frame)
+        trace.invoke(frame)
     finally:
-        del _injected_trace_funcs[frame]
-        with _trace_lock:
-            if len(_orig_trace_funcs) == 1:
-                _disable_tracing()
-            frame.f_trace = _orig_trace_funcs.pop(frame)
+        _locals_to_fast(frame)
+
+
+def _locals_to_fast(frame):
+    """Write any changes made to frame.f_locals back into the frame.
+
+    Trace functions get this for free from sys.settrace.  From Python 3.13
+    frame.f_locals writes through to the frame and there's nothing to do.
+    """
+    try:
+        import ctypes
+        locals_to_fast = ctypes.pythonapi.PyFrame_LocalsToFast
+    except (ImportError,AttributeError):
+        return
+    locals_to_fast(ctypes.py_object(frame),ctypes.c_int(0))
 
 
 def extract_code(frame,start=None,end=None,name="<withhack>"):
@@ -101,7 +334,7 @@ def extract_code(frame,start=None,end=None,name="<withhack>"):
     start_c = 0
     end_c = 0
     at = 0
-    concrete_bc = ConcreteBytecode.from_code(code)
+    concrete_bc = bytecode.ConcreteBytecode.from_code(code)
     for c in concrete_bc:
         at += c.size
         if at < start:
@@ -128,6 +361,123 @@ def extract_code(frame,start=None,end=None,name="<withhack>"):
     return bc
 
 
+class WithBlock(object):
+    """Location of a with-statement in the bytecode of a code object.
+
+    The attributes "as_clause", "body" and "teardown" are slice objects
+    selecting the corresponding parts of the with-statement from the list of
+    instructions returned by index_with_blocks().  The attribute "exit_offset"
+    gives the byte offset of the instruction that calls __exit__, or that
+    awaits __aexit__ for an "async with" statement, in which case the
+    attribute "is_async" is true.
+    """
+
+    def __init__(self,as_clause,body,teardown,exit_offset,is_async=False):
+        self.as_clause = as_clause
+        self.body = body
+        self.teardown = teardown
+        self.exit_offset = exit_offset
+        self.is_async = is_async
+
+
+#  Cache of with-statement indexes, holding the code objects weakly.
+_with_block_index = _CodeDict()
+
+
+def index_with_blocks(code):
+    """Index the with-statements in the given code object.
+
+    This returns a tuple (bc,blocks) where "bc" is a bytecode.Bytecode object
+    for the code, and "blocks" is a dict mapping the byte offset of each
+    with-statement's SETUP_WITH instruction (which is the value of f_lasti
+    when __enter__ is called) to a WithBlock object giving its location in
+    "bc".  For an "async with" statement the key is instead the offset of
+    the YIELD_FROM that awaits __aenter__.  The index is computed once per
+    code object and then cached, so neither the result nor its contents may
+    be modified.
+    """
+    try:
+        return _with_block_index[code]
+    except KeyError:
+        pass
+    concrete_bc = bytecode.ConcreteBytecode.from_code(code)
+    bc = concrete_bc.to_bytecode()
+
+    # byte offsets of the instructions, which map one-to-one onto those
+    # in the Bytecode object once any EXTENDED_ARG prefixes are merged
+    offsets = []
+    at = 0
+    for c in concrete_bc:
+        if c.name != 'EXTENDED_ARG':
+            offsets.append(at)
+        at += c.size
+    offsets.append(at)
+
+    # find the offset of each instruction, and the position of each label
+    instr_offsets = {}
+    labels = {}
+    n = 0
+    for (i,b) in enumerate(bc):
+        if isinstance(b,bytecode.instr.BaseInstr):
+            instr_offsets[i] = offsets[n]
+            n += 1
+        elif isinstance(b,bytecode.Label):
+            labels[b] = i
+    assert n == len(offsets) - 1
+
+    blocks = {}
+    for (setup,b) in enumerate(bc):
+        if not isinstance(b,bytecode.instr.BaseInstr):
+            continue
+        if b.name == 'SETUP_WITH':
+            is_async = False
+            key = setup
+        elif b.name == 'SETUP_ASYNC_WITH' and _is_instr(bc[setup-1],'YIELD_FROM'):
+            is_async = True
+            key = setup - 1
+        else:
+            continue
+        # the as clause ends by storing the value, or popping it
+        for start in range(setup+1,len(bc)):
+            if _is_instr(bc[start],*_AS_CLAUSE_ENDS):
+                break
+        start += 1
+        # the teardown code is at the SETUP_WITH target, and is preceded
+        # by POP_BLOCK/LOAD_CONST unless the block always returns
+        cleanup = labels[b.arg]
+        end = cleanup
+        if _is_instr(bc[end-1],'LOAD_CONST') and _is_instr(bc[end-2],'POP_BLOCK'):
+            if end - 2 >= start:
+                end -= 2
+        exit = cleanup + 1
+        if is_async:
+            # __aexit__ runs while its result is being awaited
+            while not _is_instr(bc[exit],'YIELD_FROM'):
+                exit += 1
+        for finish in range(cleanup+1,len(bc)):
+            if _is_instr(bc[finish],'END_FINALLY'):
+                break
+        blocks[instr_offsets[key]] = WithBlock(
+            as_clause=slice(setup+1,start),
+            body=slice(start,end),
+            teardown=slice(end,finish+1),
+            exit_offset=instr_offsets[exit],
+            is_async=is_async)
+
+    index = _with_block_index[code] = (bc,blocks)
+    return index
+
+
+#  Instructions that can end the as clause of a with-statement.
+_AS_CLAUSE_ENDS = ('STORE_FAST','STORE_NAME','STORE_GLOBAL','STORE_DEREF',
+                   'STORE_ATTR','STORE_SUBSCR','POP_TOP')
+
+
+def _is_instr(instr,*names):
+    """Check whether the given item of bytecode is one of the named instrs."""
+    return isinstance(instr,bytecode.instr.BaseInstr) and instr.name in names
+
+
 def load_name(frame,name):
     """Get the value of the named variable, as seen by the given frame.
 
@@ -0,0 +1,619 @@
+"""
+
+  withhacks.importhook:  rewrite with-statement hacks as modules are imported
+
+This module provides an import hook that rewrites the prebuilt hacks into
+equivalent plain python code at import time, so that they run at native
+speed with no frame introspection or bytecode hackery at runtime:
+
+    >>> import withhacks
+    >>> finder = withhacks.install_import_hook(["myapp"])   # doctest: +SKIP
+
+The following with-statements are rewritten, provided the hack is imported
+from withhacks under its own name (or accessed as an attribute of the
+withhacks module) and the with-statement has just the one context manager:
+
+  :namespace:        attribute assignments and lookups on the namespace
+  :keyspace:         item assignments and lookups on the keyspace
+  :xargs:            a direct call to the function after the block
+  :xkwargs:          a direct call to the function after the block
+  :CaptureFunction:  a nested function definition
+  :CaptureLocals:    a dict of the assigned locals after the block
+
+Blocks that can't be rewritten faithfully (for example, ones that contain
+"global" statements, or that can jump out of the with-statement) are left
+alone, and so fall back to the runtime implementation of the hack.
+
+Rewritten modules are cached in __pycache__ like normal modules, using an
+"opt-withhacksN" tag so that their cache files never clash with those of
+an unhooked import of the same module.
+
+"""
+
+import sys
+import ast
+import importlib.abc
+import importlib.machinery
+import importlib.util
+
+import withhacks
+
+
+__all__ = ["install_import_hook","uninstall_import_hook","rewrite_module"]
+
+#  Bump this whenever the rewriting changes, to invalidate cached modules.
+_REWRITER_VERSION = 2
+
+#  Name under which rewritten modules import the runtime helpers below.
+_RUNTIME_NAME = "_withhacks_rt"
+
+_HACK_NAMES = ("namespace","keyspace","xargs","xkwargs","CaptureFunction",
+               "CaptureLocals")
+
+
+def install_import_hook(packages):
+    """Install an import hook rewriting with-statement hacks in packages.
+
+    The argument "packages" is a list of package or module names; those
+    modules and any submodules of them will be rewritten when imported.
+    The installed finder object is returned, and can later be passed to
+    uninstall_import_hook().
+    """
+    if isinstance(packages,str):
+        packages = [packages]
+    finder = _RewritingFinder(packages)
+    sys.meta_path.insert(0,finder)
+    return finder
+
+
+def uninstall_import_hook(finder=None):
+    """Uninstall an import hook installed by install_import_hook().
+
+    If no finder is given, all withhacks import hooks are removed.  Modules
+    that have already been imported are not affected.
+    """
+    for f in list(sys.meta_path):
+        if f is finder or (finder is None and isinstance(f,_RewritingFinder)):
+            sys.meta_path.remove(f)
+
+
+def rewrite_module(tree):
+    """Rewrite any with-statement hacks in the given ast.Module, in place.
+
+    The rewritten tree is returned.
+    """
+    rewriter = _HackRewriter()
+    tree = rewriter.visit(tree)
+    if rewriter.rewrites:
+        #  Import the runtime helpers after any docstring and __future__
+        #  imports, which must come first.
+        at = 0
+        for (i,stmt) in enumerate(tree.body):
+            if i == 0 and isinstance(stmt,ast.Expr) and _is_str(stmt.value):
+                at = 1
+            elif isinstance(stmt,ast.ImportFrom) and stmt.module == "__future__":
+                at = i + 1
+        alias = ast.alias(name=__name__,asname=_RUNTIME_NAME)
+        tree.body.insert(at,ast.Import(names=[alias]))
+    return ast.fix_missing_locations(tree)
+
+
+class _RewritingFinder(importlib.abc.MetaPathFinder):
+    """Meta path finder that loads selected modules via _RewritingLoader."""
+
+    def __init__(self,packages):
+        self.packages = tuple(packages)
+
+    def find_spec(self,fullname,path,target=None):
+        for pkg in self.packages:
+            if fullname == pkg or fullname.startswith(pkg + "."):
+                break
+        else:
+            return None
+        spec = importlib.machinery.PathFinder.find_spec(fullname,path)
+        if spec is None:
+            return None
+        if not isinstance(spec.loader,importlib.machinery.SourceFileLoader):
+            return None
+        spec.loader = _RewritingLoader(spec.loader.name,spec.loader.path)
+        return spec
+
+
+class _RewritingLoader(importlib.machinery.SourceFileLoader):
+    """Source file loader that rewrites with-statement hacks.
+
+    The compiled code is cached under a tagged name in __pycache__, by
+    redirecting reads and writes of the module's normal cache file.
+    """
+
+    def source_to_code(self,data,path,*,_optimize=-1):
+        tree = compile(data,path,"exec",ast.PyCF_ONLY_AST,dont_inherit=True)
+        tree = rewrite_module(tree)
+        return compile(tree,path,"exec",dont_inherit=True,optimize=_optimize)
+
+    def get_data(self,path):
+        return super(_RewritingLoader,self).get_data(self._cache_path(path))
+
+    def set_data(self,path,data,*,_mode=0o666):
+        path = self._cache_path(path)
+        return super(_RewritingLoader,self).set_data(path,data,_mode=_mode)
+
+    def _cache_path(self,path):
+        """Map the module's normal cache file onto our tagged one."""
+        try:
+            if path != importlib.util.cache_from_source(self.path):
+                return path
+        except NotImplementedError:
+            return path
+        tag = "withhacks%d" % (_REWRITER_VERSION,)
+        if sys.flags.optimize:
+            tag += "o%d" % (sys.flags.optimize,)
+        return importlib.util.cache_from_source(self.path,optimization=tag)
+
+
+class _HackRewriter(ast.NodeTransformer):
+    """AST transformer that rewrites with-statement hacks into plain code."""
+
+    def __init__(self):
+        self.rewrites = 0
+        self.hack_aliases = {}
+        self.module_aliases = set()
+
+    def visit_Module(self,node):
+        for stmt in ast.walk(node):
+            if isinstance(stmt,ast.ImportFrom) and stmt.module == "withhacks":
+                for alias in stmt.names:
+                    if alias.name == "*":
+                        for name in _HACK_NAMES:
+                            self.hack_aliases[name] = name
+                    elif alias.name in _HACK_NAMES:
+                        self.hack_aliases[alias.asname or alias.name] = alias.name
+            elif isinstance(stmt,ast.Import):
+                for alias in stmt.names:
+                    if alias.name == "withhacks":
+                        self.module_aliases.add(alias.asname or alias.name)
+        if not self.hack_aliases and not self.module_aliases:
+            return node
+        return self.generic_visit(node)
+
+    def visit_With(self,node):
+        self.generic_visit(node)
+        if len(node.items) != 1:
+            return node
+        call = node.items[0].context_expr
+        if not isinstance(call,ast.Call):
+            return node
+        hack = self._hack_name(call.func)
+        if hack is None:
+            return node
+        rewrite = getattr(self,"_rewrite_" + hack)
+        stmts = rewrite(node,call,node.items[0].optional_vars)
+        if stmts is None:
+            return node
+        self.rewrites += 1
+        for stmt in stmts:
+            if not hasattr(stmt,"lineno"):
+                ast.copy_location(stmt,node)
+        return stmts
+
+    def _hack_name(self,func):
+        """Get the name of the hack called by the given expression, if any."""
+        if isinstance(func,ast.Name):
+            return self.hack_aliases.get(func.id)
+        if isinstance(func,ast.Attribute) and func.attr in _HACK_NAMES:
+            if isinstance(func.value,ast.Name):
+                if func.value.id in self.module_aliases:
+                    return func.attr
+        return None
+
+    def _temp(self,kind):
+        """Get a fresh temporary variable name."""
+        return "_withhacks_%s_%d" % (kind,self.rewrites)
+
+    def _rewrite_namespace(self,node,call,target,keys=False):
+        if call.keywords or len(call.args) > 1 or _has_starred(call.args):
+            return None
+        if not _can_rewrite_block(node.body,bind_only_names=True):
+            return None
+        ns = self._temp("ns")
+        if call.args:
+            value = call.args[0]
+        elif keys:
+            value = ast.Dict(keys=[],values=[])
+        else:
+            value = _runtime_call("_new_bucket",[])
+        stmts = [_assign(ns,value)]
+        body = _NamespaceBody(ns,keys,self._temp("def"))
+        for stmt in node.body:
+            stmt = body.visit(stmt)
+            if isinstance(stmt,list):
+                stmts.extend(stmt)
+            else:
+                stmts.append(stmt)
+        if target is not None:
+            stmts.append(ast.Assign(targets=[target],value=_load(ns)))
+        stmts.append(_delete(ns))
+        return stmts
+
+    def _rewrite_keyspace(self,node,call,target):
+        return self._rewrite_namespace(node,call,target,keys=True)
+
+    def _rewrite_xargs(self,node,call,target,keywords=False):
+        if not call.args or _has_starred(call.args[:1]):
+            return None
+        if not _can_rewrite_block(node.body):
+            return None
+        (func,args,kwds) = (self._temp("f"),self._temp("a"),self._temp("k"))
+        bound = self._temp("l")
+        #  Evaluate the arguments before the block, as the hack would.
+        stmts = [_assign(func,call.args[0]),
+                 _assign(args,ast.Tuple(elts=call.args[1:],ctx=ast.Load())),
+                 _assign(kwds,ast.Dict(keys=[k.arg and _str(k.arg) for k in call.keywords],
+                                       values=[k.value for k in call.keywords]))]
+        stmts.extend(node.body)
+        stmts.extend(_collect_bound(bound,_assigned_names(node.body)))
+        if keywords:
+            values = ast.Dict(keys=[None,None],values=[_load(kwds),_load(bound)])
+            result = _call(_load(func),[_starred(args)],[ast.keyword(arg=None,value=values)])
+        else:
+            values = _call(ast.Attribute(value=_load(bound),attr="values",ctx=ast.Load()),[])
+            result = _call(_load(func),
+                           [_starred(args),ast.Starred(value=values,ctx=ast.Load())],
+                           [ast.keyword(arg=None,value=_load(kwds))])
+        if target is not None:
+            stmts.append(ast.Assign(targets=[target],value=result))
+        else:
+            stmts.append(ast.Expr(value=result))
+        stmts.append(_delete(func,args,kwds,bound))
+        return stmts
+
+    def _rewrite_xkwargs(self,node,call,target):
+        return self._rewrite_xargs(node,call,target,keywords=True)
+
+    def _rewrite_CaptureLocals(self,node,call,target):
+        if call.args or call.keywords:
+            return None
+        if not _can_rewrite_block(node.body):
+            return None
+        stmts = list(node.body)
+        if target is not None:
+            bound = self._temp("l")
+            stmts.extend(_collect_bound(bound,_assigned_names(node.body)))
+            result = _runtime_call("_captured_locals",[_load(bound)])
+            stmts.append(ast.Assign(targets=[target],value=result))
+            stmts.append(_delete(bound))
+        return stmts
+
+    def _rewrite_CaptureFunction(self,node,call,target):
+        params = ("args","varargs","varkwargs","name","argdefs")
+        if _has_starred(call.args) or len(call.args) > len(params):
+            return None
+        given = dict(zip(params,call.args))
+        for kwd in call.keywords:
+            if kwd.arg not in params or kwd.arg in given:
+                return None
+            given[kwd.arg] = kwd.value
+        try:
+            argnames = list(_literal(given.get("args"),[]))
+            varargs = _literal(given.get("varargs"),False)
+            varkwargs = _literal(given.get("varkwargs"),False)
+            name = _literal(given.get("name"),"<withhack>")
+        except ValueError:
+            return None
+        if not all(isinstance(nm,str) for nm in argnames):
+            return None
+        if len(argnames) < bool(varargs) + bool(varkwargs):
+            return None
+        if not _can_rewrite_block(node.body,allow_return=True):
+            return None
+        kwarg = vararg = None
+        if varkwargs:
+            kwarg = ast.arg(arg=argnames.pop(),annotation=None)
+        if varargs:
+            vararg = ast.arg(arg=argnames.pop(),annotation=None)
+        arguments = dict(args=[ast.arg(arg=nm,annotation=None) for nm in argnames],
+                         vararg=vararg,kwonlyargs=[],kw_defaults=[],kwarg=kwarg,
+                         defaults=[])
+        if "posonlyargs" in ast.arguments._fields:
+            arguments["posonlyargs"] = []
+        fn = self._temp("fn")
+        argdefs = given.get("argdefs",ast.Tuple(elts=[],ctx=ast.Load()))
+        funcdef = dict(name=fn,args=ast.arguments(**arguments),body=node.body,
+                       decorator_list=[],returns=None)
+        if "type_params" in ast.FunctionDef._fields:
+            funcdef["type_params"] = []
+        stmts = [ast.FunctionDef(**funcdef)]
+        result = _runtime_call("_captured_function",[_load(fn),_str(name),argdefs])
+        if target is not None:
+            stmts.append(ast.Assign(targets=[target],value=result))
+        else:
+            stmts.append(ast.Expr(value=result))
+        stmts.append(_delete(fn))
+        return stmts
+
+
+class _NamespaceBody(ast.NodeTransformer):
+    """AST transformer redirecting a block's variables into a namespace.
+
+    Only names in the block's own scope are redirected, matching the names
+    that the runtime namespace() hack rewrites in the block's bytecode.
+    """
+
+    def __init__(self,ns,keys,def_name):
+        self.ns = ns
+        self.keys = keys
+        self.def_name = def_name
+
+    def _target(self,name,ctx):
+        if self.keys:
+            return _subscript(_load(self.ns),_str(name),ctx)
+        return ast.Attribute(value=_load(self.ns),attr=name,ctx=ctx)
+
+    def _contains(self,name):
+        if self.keys:
+            return ast.Compare(left=_str(name),ops=[ast.In()],
+                               comparators=[_load(self.ns)])
+        return _call(_load("hasattr"),[_load(self.ns),_str(name)])
+
+    def _lookup(self,name):
+        #  Look in the namespace first, then in the enclosing scopes.
+        return ast.IfExp(test=self._contains(name),
+                         body=self._target(name,ast.Load()),
+                         orelse=_load(name))
+
+    def visit_Name(self,node):
+        #  Leave alone the temporaries of hacks rewritten inside this one.
+        if node.id.startswith("_withhacks_"):
+            return node
+        if isinstance(node.ctx,ast.Load):
+            return ast.copy_location(self._lookup(node.id),node)
+        return ast.copy_location(self._target(node.id,node.ctx),node)
+
+    def visit_AugAssign(self,node):
+        if not isinstance(node.target,ast.Name):
+            return self.generic_visit(node)
+        #  Seed the namespace from the enclosing scopes if need be, then
+        #  update it in place so that e.g. a list's __iadd__ gets called.
+        name = node.target.id
+        seed = ast.If(test=ast.UnaryOp(op=ast.Not(),operand=self._contains(name)),
+                      body=[ast.Assign(targets=[self._target(name,ast.Store())],
+                                       value=_load(name))],
+                      orelse=[])
+        update = ast.AugAssign(target=self._target(name,ast.Store()),op=node.op,
+                               value=self.visit(node.value))
+        return [ast.copy_location(seed,node),ast.copy_location(update,node)]
+
+    def _visit_def(self,node):
+        #  Only the parts evaluated in the block's scope are rewritten; the
+        #  definition is bound under a temporary name and then moved into
+        #  the namespace.
+        for child in _scope_children(node):
+            _replace_child(node,child,self.visit(child))
+        name = node.name
+        node.name = self.def_name
+        move = ast.Assign(targets=[self._target(name,ast.Store())],
+                          value=_runtime_call("_rename",[_load(self.def_name),_str(name)]))
+        return [node,ast.copy_location(move,node),
+                ast.copy_location(_delete(self.def_name),node)]
+
+    visit_FunctionDef = _visit_def
+    visit_AsyncFunctionDef = _visit_def
+    visit_ClassDef = _visit_def
+
+    def _visit_scope(self,node):
+        for child in _scope_children(node):
+            _replace_child(node,child,self.visit(child))
+        return node
+
+    visit_Lambda = _visit_scope
+    visit_ListComp = _visit_scope
+    visit_SetComp = _visit_scope
+    visit_DictComp = _visit_scope
+    visit_GeneratorExp = _visit_scope
+
+
+def _scope_children(node):
+    """Get the children of a node that are evaluated in the node's scope.
+
+    For nodes introducing a new scope, these are the parts evaluated in the
+    enclosing scope: decorators, defaults, annotations, base classes and the
+    first iterable of a comprehension.
+    """
+    if isinstance(node,(ast.FunctionDef,ast.AsyncFunctionDef,ast.Lambda)):
+        children = []
+        if not isinstance(node,ast.Lambda):
+            children.extend(node.decorator_list)
+        args = node.args
+        children.extend(args.defaults)
+        children.extend(d for d in args.kw_defaults if d is not None)
+        if not isinstance(node,ast.Lambda):
+            for arg in getattr(args,"posonlyargs",[]) + args.args + args.kwonlyargs:
+                if arg.annotation is not None:
+                    children.append(arg.annotation)
+            for arg in (args.vararg,args.kwarg):
+                if arg is not None and arg.annotation is not None:
+                    children.append(arg.annotation)
+            if node.returns is not None:
+                children.append(node.returns)
+        return children
+    if isinstance(node,ast.ClassDef):
+        return node.decorator_list + node.bases + [k.value for k in node.keywords]
+    if isinstance(node,(ast.ListComp,ast.SetComp,ast.DictComp,ast.GeneratorExp)):
+        return [node.generators[0].iter]
+    return list(ast.iter_child_nodes(node))
+
+
+def _replace_child(node,old,new):
+    """Replace a direct child of the given node, wherever it appears."""
+    for (field,value) in ast.iter_fields(node):
+        if value is old:
+            setattr(node,field,new)
+        elif isinstance(value,list):
+            value[:] = [new if v is old else v for v in value]
+        elif isinstance(value,ast.AST) and not isinstance(value,ast.expr):
+            #  e.g. the "arguments" node of a function, or a comprehension
+            _replace_child(value,old,new)
+
+
+def _walk_scope(nodes):
+    """Iterate over the given nodes and their descendants in the same scope.
+
+    Nodes are produced in source order, and each is paired with a flag
+    saying whether it is inside a loop that is itself inside the block.
+    """
+    for node in nodes:
+        yield (node,False)
+        for item in _walk_scope_node(node,False):
+            yield item
+
+
+def _walk_scope_node(node,in_loop):
+    for child in _scope_children(node):
+        child_in_loop = in_loop
+        if isinstance(node,(ast.For,ast.AsyncFor,ast.While)):
+            child_in_loop = child_in_loop or child not in node.orelse
+        yield (child,child_in_loop)
+        for item in _walk_scope_node(child,child_in_loop):
+            yield item
+
+
+def _can_rewrite_block(body,allow_return=False,bind_only_names=False):
+    """Check whether a with-statement block can be rewritten faithfully.
+
+    Blocks that declare globals, that can leave the with-statement early,
+    or that contain yields are rejected.  If "bind_only_names" is true,
+    blocks that bind variables other than via plain names (for example with
+    an import or an "except ... as" clause) are also rejected.
+    """
+    for (node,in_loop) in _walk_scope(body):
+        if isinstance(node,(ast.Global,ast.Nonlocal,ast.Yield,ast.YieldFrom,
+                            ast.Await)):
+            return False
+        if isinstance(node,ast.Return) and not allow_return:
+            return False
+        if isinstance(node,(ast.Break,ast.Continue)) and not in_loop:
+            return False
+        if type(node).__name__ in ("NamedExpr","Match"):
+            return False
+        if bind_only_names and isinstance(node,(ast.Import,ast.ImportFrom)):
+            return False
+        if bind_only_names and isinstance(node,ast.ExceptHandler) \
+                and node.name is not None:
+            return False
+    return True
+
+
+def _assigned_names(body):
+    """Get the local variable names assigned in a block, in order."""
+    names = []
+    for (node,_) in _walk_scope(body):
+        if isinstance(node,ast.Name) and isinstance(node.ctx,ast.Store):
+            name = node.id
+        elif isinstance(node,(ast.FunctionDef,ast.AsyncFunctionDef,ast.ClassDef)):
+            name = node.name
+        elif isinstance(node,ast.alias):
+            name = node.asname or node.name.split(".")[0]
+        else:
+            continue
+        if name not in names:
+            names.append(name)
+    return names
+
+
+def _collect_bound(var,names):
+    """Get statements collecting the given variables into a dict.
+
+    Variables that are unbound, say because the branch assigning them
+    wasn't taken, are left out of the dict just as the hacks would.
+    """
+    stmts = [_assign(var,ast.Dict(keys=[],values=[]))]
+    for nm in names:
+        store = ast.Assign(targets=[_subscript(_load(var),_str(nm),ast.Store())],
+                           value=_load(nm))
+        skip = ast.ExceptHandler(type=_load("NameError"),name=None,body=[ast.Pass()])
+        stmts.append(ast.Try(body=[store],handlers=[skip],orelse=[],finalbody=[]))
+    return stmts
+
+
+def _has_starred(args):
+    return any(isinstance(arg,ast.Starred) for arg in args)
+
+
+def _literal(node,default):
+    if node is None:
+        return default
+    return ast.literal_eval(node)
+
+
+def _is_str(node):
+    if sys.version_info >= (3,8):
+        return isinstance(node,ast.Constant) and isinstance(node.value,str)
+    return isinstance(node,ast.Str)
+
+
+def _str(value):
+    if sys.version_info >= (3,8):
+        return ast.Constant(value=value)
+    return ast.Str(s=value)
+
+
+def _load(name):
+    return ast.Name(id=name,ctx=ast.Load())
+
+
+def _assign(name,value):
+    return ast.Assign(targets=[ast.Name(id=name,ctx=ast.Store())],value=value)
+
+
+def _delete(*names):
+    return ast.Delete(targets=[ast.Name(id=nm,ctx=ast.Del()) for nm in names])
+
+
+def _starred(name):
+    return ast.Starred(value=_load(name),ctx=ast.Load())
+
+
+def _subscript(value,key,ctx):
+    if sys.version_info < (3,9):
+        key = ast.Index(value=key)
+    return ast.Subscript(value=value,slice=key,ctx=ctx)
+
+
+def _call(func,args,keywords=()):
+    return ast.Call(func=func,args=list(args),keywords=list(keywords))
+
+
+def _runtime_call(name,args):
+    func = ast.Attribute(value=_load(_RUNTIME_NAME),attr=name,ctx=ast.Load())
+    return _call(func,args)
+
+
+#  Runtime helpers called by rewritten code.
+
+def _new_bucket():
+    """Create the default namespace object for namespace()."""
+    return withhacks._Bucket()
+
+
+def _rename(obj,name):
+    """Give a function or class defined in a namespace its proper name."""
+    prefix = obj.__qualname__.rpartition(".")[0]
+    obj.__name__ = name
+    obj.__qualname__ = prefix + "." + name if prefix else name
+    return obj
+
+
+def _captured_locals(locals):
+    """Build the "as" value for a rewritten CaptureLocals() block."""
+    captured = withhacks._Bucket()
+    captured.locals = locals
+    return captured
+
+
+def _captured_function(func,name,argdefs):
+    """Build the "as" value for a rewritten CaptureFunction() block."""
+    func.__name__ = func.__qualname__ = name
+    func.__defaults__ = tuple(argdefs) or None
+    captured = withhacks._Bucket()
+    captured.function = func
+    return captured
@@ -0,0 +1,288 @@
+"""
+
+  withhacks.instrument:  per-call-site statistics for the hacks
+
+This module records what the hacks cost at each with-statement that uses
+them.  Recording is off by default and costs nothing until it's enabled:
+
+    >>> import withhacks
+    >>> withhacks.enable_stats()
+    >>> def f():
+    ...     with withhacks.namespace() as ns:
+    ...         x = 1
+    ...     return ns
+    ...
+    >>> for _ in range(3):
+    ...     ns = f()
+    >>> withhacks.disable_stats()
+    >>> [(key.name,key.hack,s["enters"],s["exits"])
+    ...  for (key,s) in withhacks.stats().items()]
+    [('f', 'namespace', 3, 3)]
+    >>> withhacks.reset_stats()
+
+The statistics are keyed by a SiteKey giving the filename, function name
+and line number of the with-statement, and the name of the hack class.
+Each key maps to a dict of the following counters:
+
+  :enters:        number of times the hack was entered
+  :exits:         number of times the hack was exited
+  :enter_time:    seconds spent in __enter__
+  :exit_time:     seconds spent in __exit__, including capture and compile
+  :capture_time:  seconds spent capturing the block's bytecode
+  :compile_time:  seconds spent compiling code from the captured bytecode
+  :cache_hits:    captures and compilations served from the call site cache
+  :cache_misses:  captures and compilations that had to be done afresh
+  :trace_time:    seconds for which tracing was active on behalf of the hack
+
+Functions registered with add_stats_callback() are called as each event is
+recorded, with arguments (key,event,duration).  The event is one of "enter",
+"exit", "capture", "compile", "cache_hit", "cache_miss" or "trace", and the
+duration is in seconds, or None for the cache events.  This makes it easy to
+forward the figures to an external metrics system.
+
+While recording is enabled, the methods of each WithHack subclass are
+replaced with timing wrappers.  Subclasses defined while it's enabled are
+timed through the methods they inherit, but not through methods of their
+own; enable recording after your hacks have been defined.
+
+"""
+
+import time
+import _thread
+import collections
+
+from withhacks import frameutils
+
+
+__all__ = ["SiteKey","stats","reset_stats","enable_stats","disable_stats",
+           "stats_enabled","add_stats_callback","remove_stats_callback"]
+
+
+SiteKey = collections.namedtuple("SiteKey","filename name lineno hack")
+
+_COUNTERS = ("enters","exits","enter_time","exit_time","capture_time",
+             "compile_time","cache_hits","cache_misses","trace_time")
+
+#  Map from SiteKey to a dict of counters.
+_stats = {}
+_stats_lock = _thread.allocate_lock()
+
+_callbacks = []
+
+#  Methods replaced by timing wrappers, as a list of (class,name,original).
+_installed = []
+
+#  SiteKey of each hack object between its __enter__ and __exit__, by id.
+_active_keys = {}
+
+
+class _ThreadState(_thread._local):
+    """Per-thread stack of the call sites whose hacks are running."""
+    def __init__(self):
+        self.keys = []
+
+_thread_state = _ThreadState()
+
+
+def _current_key():
+    """Get the SiteKey of the innermost hack method running in this thread."""
+    keys = _thread_state.keys
+    return keys[-1] if keys else None
+
+
+def _record(key,event,duration=None,**counts):
+    """Add to the counters for the given call site, and notify callbacks."""
+    if key is None:
+        return
+    with _stats_lock:
+        try:
+            counters = _stats[key]
+        except KeyError:
+            counters = _stats[key] = dict.fromkeys(_COUNTERS,0)
+        for (name,amount) in counts.items():
+            counters[name] += amount
+    for callback in list(_callbacks):
+        callback(key,event,duration)
+
+
+def stats():
+    """Get a snapshot of the statistics recorded for each call site.
+
+    The result is a dict mapping SiteKey tuples to dicts of counters.
+    """
+    with _stats_lock:
+        return dict((key,dict(counters)) for (key,counters) in _stats.items())
+
+
+def reset_stats():
+    """Discard all statistics recorded so far."""
+    with _stats_lock:
+        _stats.clear()
+
+
+def add_stats_callback(callback):
+    """Register a function to be called with each recorded event."""
+    _callbacks.append(callback)
+
+
+def remove_stats_callback(callback):
+    """Unregister a function added with add_stats_callback()."""
+    _callbacks.remove(callback)
+
+
+def stats_enabled():
+    """Check whether statistics are currently being recorded."""
+    return bool(_installed)
+
+
+def enable_stats():
+    """Start recording statistics for every WithHack subclass."""
+    import withhacks
+    if _installed:
+        return
+    classes = [withhacks.WithHack]
+    for cls in classes:
+        classes.extend(sub for sub in cls.__subclasses__() if sub not in classes)
+    for cls in classes:
+        for (name,make_wrapper) in _WRAPPERS:
+            orig = cls.__dict__.get(name)
+            if orig is not None:
+                wrapper = make_wrapper(name,orig)
+                wrapper.__name__ = orig.__name__
+                wrapper.__doc__ = orig.__doc__
+                wrapper.__wrapped__ = orig
+                setattr(cls,name,wrapper)
+                _installed.append((cls,name,orig))
+    #  Make sure the wrappers are skipped when looking for the context frame.
+    withhacks._method_codes.clear()
+    frameutils._trace_hooks = (_on_trace_inject,_on_trace_invoke)
+
+
+def disable_stats():
+    """Stop recording statistics, keeping those recorded so far."""
+    import withhacks
+    frameutils._trace_hooks = None
+    while _installed:
+        (cls,name,orig) = _installed.pop()
+        setattr(cls,name,orig)
+    withhacks._method_codes.clear()
+    _active_keys.clear()
+
+
+def _site_key(hack):
+    """Get the SiteKey for the with-statement a hack is being entered by."""
+    frame = hack._get_context_frame()
+    code = frame.f_code
+    return SiteKey(code.co_filename,code.co_name,frame.f_lineno,
+                   type(hack).__name__)
+
+
+def _is_outermost(hack,name,wrapper):
+    """Check whether a wrapper is for the method that was called on a hack.
+
+    Wrapped methods that are invoked through super() don't record anything,
+    so that nothing gets counted twice.
+    """
+    return getattr(type(hack),name,None) is wrapper
+
+
+def _wrap_enter(name,orig):
+    def wrapper(self,*args,**kwds):
+        if not _is_outermost(self,name,wrapper):
+            return orig(self,*args,**kwds)
+        key = _active_keys[id(self)] = _site_key(self)
+        keys = _thread_state.keys
+        keys.append(key)
+        start = time.perf_counter()
+        try:
+            return orig(self,*args,**kwds)
+        except BaseException:
+            _active_keys.pop(id(self),None)
+            raise
+        finally:
+            duration = time.perf_counter() - start
+            keys.pop()
+            _record(key,"enter",duration,enters=1,enter_time=duration)
+    return wrapper
+
+
+def _wrap_exit(name,orig):
+    def wrapper(self,*args,**kwds):
+        if not _is_outermost(self,name,wrapper):
+            return orig(self,*args,**kwds)
+        key = _active_keys.pop(id(self),None)
+        keys = _thread_state.keys
+        keys.append(key)
+        start = time.perf_counter()
+        try:
+            return orig(self,*args,**kwds)
+        finally:
+            duration = time.perf_counter() - start
+            keys.pop()
+            _record(key,"exit",duration,exits=1,exit_time=duration)
+    return wrapper
+
+
+def _wrap_capture_site(name,orig):
+    import withhacks
+    def wrapper(self,frame,start,end):
+        if not _is_outermost(self,name,wrapper):
+            return orig(self,frame,start,end)
+        cached = (self.cache_bytecode and
+                  start in withhacks._capture_cache.get(frame.f_code,()))
+        t = time.perf_counter()
+        try:
+            return orig(self,frame,start,end)
+        finally:
+            duration = time.perf_counter() - t
+            key = _current_key()
+            _record(key,"capture",duration,capture_time=duration)
+            if cached:
+                _record(key,"cache_hit",cache_hits=1)
+            else:
+                _record(key,"cache_miss",cache_misses=1)
+    return wrapper
+
+
+def _wrap_compiled(name,orig):
+    def wrapper(self,cache_key,compile):
+        if not _is_outermost(self,name,wrapper):
+            return orig(self,cache_key,compile)
+        durations = []
+        def timed_compile():
+            t = time.perf_counter()
+            try:
+                return compile()
+            finally:
+                durations.append(time.perf_counter() - t)
+        value = orig(self,cache_key,timed_compile)
+        key = _current_key()
+        if durations:
+            _record(key,"compile",durations[0],compile_time=durations[0])
+            _record(key,"cache_miss",cache_misses=1)
+        else:
+            _record(key,"cache_hit",cache_hits=1)
+        return value
+    return wrapper
+
+
+#  Methods to wrap while recording, with the function building each wrapper.
+_WRAPPERS = (("__enter__",_wrap_enter),
+             ("__exit__",_wrap_exit),
+             ("_capture_site",_wrap_capture_site),
+             ("_compiled",_wrap_compiled))
+
+
+def _on_trace_inject():
+    """Note the start of tracing on behalf of the running hack."""
+    key = _current_key()
+    if key is None:
+        return None
+    return (key,time.perf_counter())
+
+
+def _on_trace_invoke(token):
+    """Record how long tracing was active for an injected function."""
+    (key,start) = token
+    duration = time.perf_counter() - start
+    _record(key,"trace",duration,trace_time=duration)
@@ -0,0 +1,141 @@
+"""
+
+  withhacks.portable:  functions that can be pickled and sent to other processes
+
+The functions built by CaptureFunction have code objects that exist only in
+the process that captured them, so they can't be pickled by reference like
+ordinary module-level functions.  This module provides a wrapper that pickles
+a function by value instead:
+
+    >>> import pickle
+    >>> from withhacks import CaptureFunction
+    >>> with CaptureFunction(("x",),portable=True) as f:
+    ...     print(x * 2)
+    ...
+    >>> double = pickle.loads(pickle.dumps(f.function))
+    >>> double(21)
+    42
+
+A pickled function consists of its marshalled code object, the name of the
+module whose globals it uses, the global names it refers to, and its default
+argument values.  On unpickling the module is imported and its globals used
+for the rebuilt function.  Each process keeps a cache of the code objects it
+has most recently unmarshalled, so a worker receiving the same function many
+times only unmarshals it once.
+
+Functions with closures can't be made portable, since their cells can't be
+transferred along with them.
+
+"""
+
+import sys
+import types
+import marshal
+import collections
+
+from withhacks.frameutils import _CodeDict
+
+
+__all__ = ["PortableFunction"]
+
+#  Marshalled form of each code object that has been pickled, as a tuple
+#  (key,data,global_names).  The key identifies the code across processes.
+_marshalled_codes = _CodeDict()
+
+#  Code objects that have been unmarshalled in this process, by key, with
+#  the most recently used last.  Only the last few hundred are kept.
+_unmarshalled_codes = collections.OrderedDict()
+_MAX_UNMARSHALLED_CODES = 256
+
+
+class PortableFunction(object):
+    """Wrapper making a function picklable by value.
+
+    Calling the wrapper calls the wrapped function, which is also available
+    as the attribute "function".  Other attributes are looked up on the
+    wrapped function, so the wrapper can generally stand in for it.
+    """
+
+    __slots__ = ("function","__weakref__")
+
+    def __init__(self,function):
+        if function.__closure__:
+            raise ValueError("functions with closures can't be made portable")
+        self.function = function
+
+    def __call__(self,*args,**kwds):
+        return self.function(*args,**kwds)
+
+    def __getattr__(self,name):
+        return getattr(self.function,name)
+
+    def __repr__(self):
+        return "<portable %r>" % (self.function,)
+
+    def __reduce__(self):
+        func = self.function
+        (key,data,global_names) = _marshal_code(func.__code__)
+        module = func.__globals__.get("__name__")
+        return (_rebuild,(key,data,module,global_names,func.__name__,
+                          func.__defaults__,func.__kwdefaults__))
+
+
+def _marshal_code(code):
+    """Get the (key,data,global_names) tuple for pickling a code object."""
+    try:
+        return _marshalled_codes[code]
+    except KeyError:
+        pass
+    import hashlib
+    data = marshal.dumps(code)
+    key = hashlib.sha1(data).hexdigest()
+    marshalled = (key,data,_global_names(code))
+    _marshalled_codes[code] = marshalled
+    return marshalled
+
+
+def _global_names(code):
+    """Get the sorted tuple of global names referred to by a code object."""
+    import dis
+    names = set()
+    for instr in dis.get_instructions(code):
+        if instr.opname in ("LOAD_GLOBAL","LOAD_NAME","STORE_GLOBAL",
+                            "DELETE_GLOBAL"):
+            names.add(instr.argval)
+    for const in code.co_consts:
+        if isinstance(const,types.CodeType):
+            names.update(_global_names(const))
+    return tuple(sorted(names))
+
+
+def _rebuild(key,data,module,global_names,name,defaults,kwdefaults):
+    """Rebuild a PortableFunction from its pickled form."""
+    try:
+        code = _unmarshalled_codes[key]
+        _unmarshalled_codes.move_to_end(key)
+    except KeyError:
+        code = _unmarshalled_codes[key] = marshal.loads(data)
+        while len(_unmarshalled_codes) > _MAX_UNMARSHALLED_CODES:
+            _unmarshalled_codes.popitem(last=False)
+    if module is None:
+        globals = None
+    else:
+        try:
+            globals = sys.modules[module].__dict__
+        except KeyError:
+            try:
+                import importlib
+                globals = importlib.import_module(module).__dict__
+            except ImportError:
+                globals = None
+    if globals is None:
+        builtins = sys.modules["builtins"].__dict__
+        missing = [nm for nm in global_names if nm not in builtins]
+        if missing:
+            msg = "module %r is needed for globals %s" % (module,
+                                                          ", ".join(missing))
+            raise ImportError(msg)
+        globals = {"__name__": module,"__builtins__": builtins}
+    func = types.FunctionType(code,globals,name,defaults)
+    func.__kwdefaults__ = kwdefaults
+    return PortableFunction(func)
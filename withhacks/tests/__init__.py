@@ -3,11 +3,25 @@ from __future__ import with_statement
 
 import os
 import sys
+import ast
+import gc
+import shutil
+import subprocess
+import asyncio
+import pickle
+import threading
+import tempfile
+import textwrap
+import types
 import unittest
+import weakref
 import doctest
+import inspect
 
 import withhacks
+import withhacks.importhook
 from withhacks import *
+from withhacks import frameutils
 
 
 class TestXArgs(unittest.TestCase):
@@ -19,14 +33,14 @@ class TestXArgs(unittest.TestCase):
              a = 1
              b = 2
              c = 3
-        self.assertEquals(v,1*2*3)
+        self.assertEqual(v,1*2*3)
         with xargs(func,7) as v:
              x = 8
              y = 9
-        self.assertEquals(v,7*8*9)
+        self.assertEqual(v,7*8*9)
         with xargs(func,7) as v:
              b = 8
-        self.assertEquals(v,7*8*42)
+        self.assertEqual(v,7*8*42)
 
     def test_xkwargs(self):
         def func(a,b,c=42):
@@ -35,16 +49,16 @@ class TestXArgs(unittest.TestCase):
              a = 1
              b = 2
              c = 3
-        self.assertEquals(v,1*1 - 2 + 3)
+        self.assertEqual(v,1*1 - 2 + 3)
         with xkwargs(func,b=2) as v:
              c = 4
              a = -1
-        self.assertEquals(v,1*1 - 2 + 4)
+        self.assertEqual(v,1*1 - 2 + 4)
         with xkwargs(func,b=2) as v:
              c = 3
              a = 1
              c = 5
-        self.assertEquals(v,1*1 - 2 + 5)
+        self.assertEqual(v,1*1 - 2 + 5)
 
 
 class TestNamespace(unittest.TestCase):
@@ -53,61 +67,186 @@ class TestNamespace(unittest.TestCase):
         a = 42
         with namespace() as ns:
             a = 2*a
-        self.assertEquals(ns.a,42*2)
+        self.assertEqual(ns.a,42*2)
         with namespace() as ns:
             a = 7
             b = a * 4
             v = ValueError
-        self.assertEquals(ns.b,7*4)
-        self.assertEquals(ns.v,ValueError)
+        self.assertEqual(ns.b,7*4)
+        self.assertEqual(ns.v,ValueError)
         b = withhacks._Bucket()
         with namespace(b):
             def hello():
                 return "hi there"
             def howzitgoin():
                 return "fine thanks"
-        self.assertEquals(b.hello(),"hi there")
-        self.assertEquals(b.howzitgoin(),"fine thanks")
+        self.assertEqual(b.hello(),"hi there")
+        self.assertEqual(b.howzitgoin(),"fine thanks")
         with namespace(b):
             del hello
         self.assertRaises(AttributeError,getattr,b,"hello")
-        self.assertEquals(b.howzitgoin(),"fine thanks")
+        self.assertEqual(b.howzitgoin(),"fine thanks")
 
     def test_keyspace(self):
         a = 42
         with keyspace() as d:
             a = 2*a
-        self.assertEquals(d["a"],42*2)
+        self.assertEqual(d["a"],42*2)
         with keyspace() as d:
             a = 7
             b = a * 4
             v = ValueError
-        self.assertEquals(d["b"],7*4)
-        self.assertEquals(d["v"],ValueError)
+        self.assertEqual(d["b"],7*4)
+        self.assertEqual(d["v"],ValueError)
         d = {}
         with keyspace(d):
             def hello():
                 return "hi there"
             def howzitgoin():
                 return "fine thanks"
-        self.assertEquals(d["hello"](),"hi there")
-        self.assertEquals(d["howzitgoin"](),"fine thanks")
+        self.assertEqual(d["hello"](),"hi there")
+        self.assertEqual(d["howzitgoin"](),"fine thanks")
         with keyspace(d):
             del hello
         self.assertRaises(KeyError,d.__getitem__,"hello")
-        self.assertEquals(d["howzitgoin"](),"fine thanks")
+        self.assertEqual(d["howzitgoin"](),"fine thanks")
+
+    def test_namespace_lookups(self):
+        offset = 10
+        b = withhacks._Bucket()
+        b.len = lambda x: 42
+        with namespace(b):
+            total = 0
+            for i in range(3):
+                total = total + len([i]) + offset
+        self.assertEqual(b.total,3*(42+10))
+        d = {"len": lambda x: 7}
+        with keyspace(d):
+            total = 0
+            for i in range(3):
+                total = total + len([i]) + offset + abs(-1)
+        self.assertEqual(d["total"],3*(7+10+1))
+
+    def test_keyspace_getitem(self):
+        import collections
+        d = collections.defaultdict(int)
+        with keyspace(d):
+            x = x + 1
+        self.assertEqual(d,{"x": 1})
+        class Upper(dict):
+            def __getitem__(self,key):
+                return dict.__getitem__(self,key.upper())
+        u = Upper(A=2)
+        with keyspace(u):
+            b = a * 3
+        self.assertEqual(u,{"A": 2,"b": 6})
+        d = collections.defaultdict(int)
+        with keyspace(d,buffered=True):
+            y = y + 2
+        self.assertEqual(d,{"y": 2})
+
+    def test_keyspace_getitem_only(self):
+        class Mapping(object):
+            def __init__(self,**items):
+                self.items = items
+            def __getitem__(self,key):
+                return self.items[key]
+            def __setitem__(self,key,value):
+                self.items[key] = value
+            def __delitem__(self,key):
+                del self.items[key]
+        offset = 10
+        m = Mapping(a=1,b=2)
+        with keyspace(m):
+            c = a + offset
+            del b
+        self.assertEqual(m.items,{"a": 1,"c": 11})
+        def flush(items,deleted):
+            for key in deleted:
+                del m[key]
+            for (key,value) in items.items():
+                m[key] = value
+        with keyspace(m,buffered=True,flush=flush):
+            d = c + a
+            del a
+        self.assertEqual(m.items,{"c": 11,"d": 12})
 
     def test_keyspace_save_name(self):
         d = {'a': [1]}
         with keyspace() as d['a'][0]:
             x = 1
-        self.assertEquals(d['a'][0]['x'], 1)
+        self.assertEqual(d['a'][0]['x'], 1)
 
     def test_keyspace_save_global(self):
         global d
         with keyspace() as d:
             x = 1
-        self.assertEquals(d['x'], 1)
+        self.assertEqual(d['x'], 1)
+
+    def test_as_clause(self):
+        class Target(object):
+            pass
+        t = Target()
+        d = {"a": [None,None]}
+        for i in range(3):
+            with xkwargs(dict) as d["a"][i % 2]:
+                x = i
+            with keyspace() as t.ks:
+                y = i
+        self.assertEqual(d,{"a": [{"x": 2},{"x": 1}]})
+        self.assertEqual(t.ks,{"y": 2})
+        sites = withhacks._capture_cache[sys._getframe().f_code].values()
+        sites = [s for s in sites if (CaptureBytecode,"as_clause") in s.compiled]
+        self.assertEqual(len(sites),2)
+        #  The as clause doesn't inherit the generator's flags.
+        def gen():
+            with xkwargs(dict) as t.kw:
+                z = 1
+            yield t.kw["z"]
+        self.assertEqual(list(gen()),[1])
+
+    def test_keyspace_buffered(self):
+        class Mapping(dict):
+            writes = 0
+            def __setitem__(self,key,value):
+                self.writes += 1
+                super(Mapping,self).__setitem__(key,value)
+            def update(self,items):
+                self.writes += 1
+                super(Mapping,self).update(items)
+        m = Mapping(a=1,b=2)
+        with keyspace(m,buffered=True):
+            for i in range(100):
+                c = a + i
+                self.assertEqual(m.get("c"),None)
+            a = c
+            del b
+            b = 3
+            del b
+        self.assertEqual(m,{"a": 100,"c": 100,"i": 99})
+        self.assertEqual(m.writes,1)
+        #  Nothing is written if the block fails.
+        try:
+            with keyspace(m,buffered=True):
+                z = 1
+                raise RuntimeError
+        except RuntimeError:
+            pass
+        self.assertFalse("z" in m)
+        #  Custom bulk writes, inside a transaction.
+        log = []
+        class Transaction(object):
+            def __enter__(self):
+                log.append("begin")
+            def __exit__(self,*args):
+                log.append("commit")
+        def flush(items,deleted):
+            log.append((sorted(items.items()),deleted))
+        with keyspace(m,buffered=True,flush=flush,transaction=Transaction):
+            x = a
+            del c
+        self.assertEqual(log,["begin",([("x",100)],["c"]),"commit"])
+        self.assertFalse("x" in m)
 
 
 class TestCaptureFunction(unittest.TestCase):
@@ -115,7 +254,7 @@ class TestCaptureFunction(unittest.TestCase):
     def test_capture(self):
         with CaptureFunction() as c:
             return 42
-        self.assertEquals(c.function(),42)
+        self.assertEqual(c.function(),42)
         with CaptureFunction(("flag",)) as c:
             if not flag:
                 raise ValueError
@@ -130,10 +269,758 @@ class TestCaptureFunction(unittest.TestCase):
     def test_capture_varargs(self):
         with CaptureFunction(("kwargs",), varkwargs=True) as c:
             return kwargs
-        self.assertEquals(c.function(a=1),{'a': 1})
+        self.assertEqual(c.function(a=1),{'a': 1})
         with CaptureFunction(("args",), varargs=True) as c:
             return args
-        self.assertEquals(c.function(1, 2, 3), (1, 2, 3))
+        self.assertEqual(c.function(1, 2, 3), (1, 2, 3))
+
+
+class TestCaptureModifiedLocals(unittest.TestCase):
+
+    def test_assigned_only(self):
+        class NoEq(object):
+            def __eq__(self,other):
+                raise AssertionError("compared with ==")
+            __ne__ = __eq__
+        big = NoEq()
+        same = NoEq()
+        x = 1
+        with CaptureModifiedLocals(assigned_only=True) as c:
+            same = same
+            x = 2
+            y = 3
+        self.assertEqual(c.locals,{"x": 2,"y": 3})
+        with CaptureModifiedLocals(assigned_only=True,equality=True) as c:
+            x = 2
+            z = 4
+        self.assertEqual(c.locals,{"z": 4})
+        with CaptureModifiedLocals() as c:
+            x = 5
+        self.assertEqual(c.locals,{"x": 5})
+
+
+class TestRunIn(unittest.TestCase):
+
+    def test_run_in(self):
+        from concurrent.futures import ThreadPoolExecutor
+        main_thread = threading.current_thread()
+        items = [1,2,3]
+        total = None
+        with ThreadPoolExecutor(2) as executor:
+            with run_in(executor) as future:
+                total = sum(items)
+                thread = threading.current_thread()
+            with run_in(executor) as future2:
+                return len(items)
+            self.assertEqual(future2.result(),3)
+            self.assertEqual(future.result(),None)
+        self.assertEqual(total,6)
+        self.assertFalse(thread is main_thread)
+        self.assertEqual(future.locals,{"total": 6,"thread": thread})
+
+    def test_run_in_closure(self):
+        from concurrent.futures import ThreadPoolExecutor
+        x = 2
+        get_x = lambda: x
+        with ThreadPoolExecutor(1) as executor:
+            with run_in(executor) as future:
+                y = x * 2
+            future.result()
+        self.assertEqual((y,get_x()),(4,2))
+
+    def test_run_in_frame_reused(self):
+        from concurrent.futures import ThreadPoolExecutor
+        def job(executor,prev=None):
+            total = "untouched"
+            if prev is None:
+                with run_in(executor) as future:
+                    total = 123
+                return future
+            prev.result()
+            return total
+        with ThreadPoolExecutor(1) as executor:
+            future = job(executor)
+            #  The second call may run in the same frame object as the first.
+            self.assertEqual(job(executor,future),"untouched")
+        self.assertEqual(future.locals,{"total": 123})
+
+    def test_run_in_futures(self):
+        from concurrent import futures
+        class Marker(object):
+            pass
+        def submit(executor,n):
+            marker = Marker()
+            with run_in(executor) as future:
+                return n * 2
+            return (future,weakref.ref(marker))
+        with futures.ThreadPoolExecutor(2) as executor:
+            pending = [submit(executor,n) for n in range(3)]
+            fs = [future for (future,_) in pending]
+            self.assertTrue(all(isinstance(f,futures.Future) for f in fs))
+            #  The futures don't keep the submitting frames alive.
+            gc.collect()
+            self.assertTrue(all(ref() is None for (_,ref) in pending))
+            (done,not_done) = futures.wait(fs)
+            self.assertEqual((len(done),len(not_done)),(3,0))
+            results = [f.result() for f in futures.as_completed(fs)]
+            self.assertEqual(sorted(results),[0,2,4])
+
+
+class TestAsync(unittest.TestCase):
+
+    def _run(self,coro):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coro)
+        finally:
+            loop.close()
+
+    def test_namespace(self):
+        async def double(x):
+            await asyncio.sleep(0)
+            return 2 * x
+        async def main():
+            a = 21
+            async with namespace() as ns:
+                b = await double(a)
+            async with keyspace() as ks:
+                c = a
+                a = c + 1
+            get_a = lambda: a
+            return (ns,ks,a)
+        (ns,ks,a) = self._run(main())
+        self.assertEqual(ns.b,42)
+        self.assertEqual(ks,{"a": 22,"c": 21})
+        self.assertEqual(a,21)
+
+    def test_namespace_await_raises(self):
+        m = {}
+        async def main():
+            ns = ks = None
+            try:
+                async with namespace() as ns:
+                    await asyncio.sleep(0)
+                    raise ValueError
+            except ValueError:
+                pass
+            try:
+                async with keyspace(m,buffered=True) as ks:
+                    x = 1
+                    await asyncio.sleep(0)
+                    raise ValueError
+            except ValueError:
+                pass
+            return (ns,ks)
+        #  Nothing is bound or written until the block has been awaited.
+        (ns,ks) = self._run(main())
+        self.assertFalse(isinstance(ns,withhacks._Bucket))
+        self.assertFalse(ks is m)
+        self.assertEqual(m,{})
+
+    def test_capture(self):
+        async def main():
+            async with CaptureFunction(("x",)) as f:
+                await asyncio.sleep(0)
+                return x + 1
+            async with xkwargs(dict,a=1) as d:
+                b = await f.function(1)
+            with CaptureFunction(("y",)) as g:
+                return y * 2
+            return (f.function,d,g.function)
+        (func,d,g) = self._run(main())
+        self.assertTrue(asyncio.iscoroutinefunction(func))
+        self.assertEqual(self._run(func(41)),42)
+        self.assertEqual(d,{"a": 1,"b": 2})
+        self.assertEqual(g(2),4)
+
+
+class TestParallelMap(unittest.TestCase):
+
+    def test_threads(self):
+        scale = 3
+        with parallel_map(range(20),arg="x",workers=4) as results:
+            y = x * scale
+            return (x,y,threading.current_thread())
+        results = list(results)
+        self.assertEqual([r[:2] for r in results],[(i,i*3) for i in range(20)])
+        self.assertFalse(threading.current_thread() in [r[2] for r in results])
+
+    def test_processes(self):
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(2) as executor:
+            with parallel_map(range(10),executor=executor,chunksize=3) as pids:
+                return (item,os.getpid())
+            pids = list(pids)
+        self.assertEqual([i for (i,pid) in pids],list(range(10)))
+        self.assertFalse(os.getpid() in [pid for (i,pid) in pids])
+
+    def test_streaming(self):
+        read = []
+        def items():
+            for i in range(1000):
+                read.append(i)
+                yield i
+        with parallel_map(items(),arg="x",workers=2,chunksize=5) as results:
+            return (x,threading.current_thread().name)
+        #  Only a few chunks are read ahead of the results being consumed.
+        self.assertEqual(len(read),2 * 2 * 5)
+        first = [next(results) for _ in range(5)]
+        self.assertEqual([x for (x,_) in first],list(range(5)))
+        #  Each chunk is handled by a single worker.
+        self.assertEqual(len(set(name for (_,name) in first)),1)
+        self.assertTrue(len(read) <= 5 * 5)
+        self.assertEqual([x for (x,_) in results],list(range(5,1000)))
+        results.close()
+
+
+class TestPortable(unittest.TestCase):
+
+    def test_docstrings(self):
+        assert doctest.testmod(withhacks.portable)[0] == 0
+
+    def test_pickle(self):
+        with CaptureFunction(("a","b"),argdefs=(3,),portable=True) as c:
+            return (a * b,len([a]))
+        data = pickle.dumps(c.function)
+        withhacks.portable._unmarshalled_codes.clear()
+        f1 = pickle.loads(data)
+        f2 = pickle.loads(data)
+        self.assertEqual(f1(2),(6,1))
+        self.assertTrue(f1.__code__ is f2.__code__)
+        self.assertEqual(len(withhacks.portable._unmarshalled_codes),1)
+        self.assertRaises(ValueError,PortableFunction,lambda: f1)
+
+    def test_rebuild(self):
+        rebuild = withhacks.portable._rebuild
+        (key,data,_) = withhacks.portable._marshal_code((lambda: len).__code__)
+        self.assertEqual(rebuild(key,data,None,("len",),"f",None,None)(),len)
+        self.assertRaises(ImportError,rebuild,key,data,None,("undefined",),
+                          "f",None,None)
+        #  Only the most recently used code objects are kept.
+        cache = withhacks.portable._unmarshalled_codes
+        for i in range(withhacks.portable._MAX_UNMARSHALLED_CODES + 10):
+            rebuild("key%d" % (i,),data,None,(),"f",None,None)
+        self.assertEqual(len(cache),withhacks.portable._MAX_UNMARSHALLED_CODES)
+        self.assertFalse(key in cache)
+
+    def test_run_in_process(self):
+        from concurrent.futures import ProcessPoolExecutor
+        n = 5
+        with ProcessPoolExecutor(1) as executor:
+            with run_in(executor) as future:
+                pid = os.getpid()
+                total = sum(range(n))
+            future.result()
+        self.assertEqual(total,10)
+        self.assertNotEqual(pid,os.getpid())
+
+
+class TestCaching(unittest.TestCase):
+
+    def test_capture_cache(self):
+        class KeepLocals(CaptureLocals):
+            keep_bytecode = True
+        code = sys._getframe().f_code
+        results = []
+        for i in range(3):
+            with KeepLocals() as c:
+                x = i
+            results.append(c.locals)
+            c.bytecode[:] = []
+        self.assertEqual(results,[{'x': 0},{'x': 1},{'x': 2}])
+        self.assertEqual(len(withhacks._capture_cache[code]),1)
+
+    def test_as_target_with_jump(self):
+        class Context(object):
+            def __enter__(self):
+                return "entered"
+            def __exit__(self,*args):
+                pass
+        def func(c):
+            d = [None,None]
+            with Context() as d[0 if c else 1]:
+                pass
+            with namespace() as ns:
+                x = 1
+            return (d,ns)
+        (d,ns) = func(False)
+        self.assertEqual((d,ns.x),([None,"entered"],1))
+        (_,blocks) = frameutils.index_with_blocks(func.__code__)
+        self.assertEqual(len(blocks),2)
+
+    def test_capture_cache_weak(self):
+        ns = {}
+        exec("def f():\n    with namespace() as n:\n        x = 1\n    return n",
+             {"namespace": namespace},ns)
+        self.assertEqual(ns["f"]().x,1)
+        code = ns["f"].__code__
+        self.assertTrue(code in withhacks._capture_cache)
+        self.assertTrue(code in frameutils._with_block_index)
+        num_sites = len(withhacks._capture_cache)
+        del ns["f"], code
+        gc.collect()
+        self.assertEqual(len(withhacks._capture_cache),num_sites - 1)
+
+    def test_namespace_compiled_once(self):
+        def build(value):
+            with namespace() as ns:
+                x = value + 1
+            return ns
+        self.assertEqual(build(1).x,2)
+        self.assertEqual(build(2).x,3)
+        sites = withhacks._capture_cache[build.__code__]
+        (site,) = sites.values()
+        self.assertEqual(list(site.compiled),[(namespace,namespace)])
+
+    def test_function_compiled_once(self):
+        def factory(n):
+            with CaptureFunction(("acc","x"),argdefs=(n,)) as c:
+                acc.append(x * 2)
+            return c.function
+        (f1,f2) = (factory(1),factory(2))
+        out = []
+        f1(out); f2(out); f1(out,5)
+        self.assertEqual(out,[2,4,10])
+        self.assertTrue(f1.__code__ is f2.__code__)
+
+    def test_capture_large_function(self):
+        lines = ["def big():"]
+        lines.extend("    a%d = %d" % (i,i) for i in range(500))
+        lines.append("    with CaptureLocals() as c:")
+        lines.extend("        b%d = a%d" % (i,i) for i in range(0,500,100))
+        lines.extend("    a%d = %d" % (i,i) for i in range(500))
+        lines.append("    return c")
+        ns = {"CaptureLocals": CaptureLocals}
+        exec("\n".join(lines),ns)
+        c = ns["big"]()
+        self.assertEqual(c.locals,dict(("b%d" % i,i) for i in range(0,500,100)))
+
+    def test_release_bytecode(self):
+        frame = sys._getframe()
+        with CaptureFunction() as f:
+            x = 1
+        ns = namespace()
+        with ns as bucket:
+            y = 2
+        xk = xkwargs(dict)
+        with xk as d:
+            z = 3
+        self.assertEqual((bucket.y,d),(2,{"z": 3}))
+        for hack in (f,ns,xk):
+            self.assertFalse(hasattr(hack,"__dict__"))
+            self.assertEqual(hack.bytecode,None)
+            self.assertEqual(hack._as_clause,None)
+            self.assertFalse(frame in gc.get_referents(hack))
+        with CaptureBytecode() as c:
+            x = 1
+        self.assertEqual([i.name for i in c.bytecode],["LOAD_CONST","STORE_FAST"])
+
+    def test_store_names(self):
+        results = []
+        for i in range(2):
+            with CaptureOrderedLocals() as c:
+                z = i
+                for a in range(2):
+                    y = a
+                if i:
+                    x = z
+            results.append(list(c.locals.items()))
+        self.assertEqual(results,[[('z',0),('a',1),('y',1)],
+                                   [('z',1),('a',1),('y',1),('x',1)]])
+
+    def test_capture_cache_disabled(self):
+        class NoCacheLocals(CaptureLocals):
+            cache_bytecode = False
+        with NoCacheLocals() as c:
+            x = 1
+        self.assertEqual(c.locals,{'x': 1})
+        self.assertFalse(sys._getframe().f_code in withhacks._capture_cache)
+
+
+class TestContextFrame(unittest.TestCase):
+
+    def test_context_frame(self):
+        class FrameHack(WithHack):
+            def __enter__(self):
+                return (self._get_context_frame(),self._frame_from_lambda())
+            _frame_from_lambda = property(lambda self:
+                                          lambda: self._get_context_frame())
+        def enter(self):
+            #  Binding "self" to the hack must not hide this frame.
+            with self as frames:
+                return (sys._getframe(),frames)
+        (frame,frames) = enter(FrameHack())
+        self.assertTrue(frames[0] is frame)
+        self.assertTrue(frames[1] is frame)
+
+    def test_hack_inside_own_method(self):
+        class Outer(namespace):
+            def build(self,value):
+                #  Another instance of the same hack, used inside a method.
+                with Outer() as inner:
+                    x = value
+                return inner
+        class Sub(Outer):
+            def build_sub(self):
+                with Sub() as inner:
+                    y = 2
+                return inner
+        self.assertEqual(Outer().build(1).x,1)
+        self.assertEqual(Sub().build_sub().y,2)
+        self.assertEqual(Sub().build(3).x,3)
+
+
+class TestFrameUtils(unittest.TestCase):
+
+    def test_inject_trace_func(self):
+        x = 1
+        frame = sys._getframe()
+        frameutils.inject_trace_func(frame,lambda f: f.f_locals.update({"x": 2}))
+        self.assertEqual(x,2)
+
+    def test_update_locals(self):
+        x = 1
+        frameutils.update_locals(sys._getframe(),{"x": 2})
+        self.assertEqual(x,2)
+        if frameutils._locals_write_through:
+            self.assertFalse(isinstance(sys._getframe().f_trace,
+                                        frameutils._TraceInjector))
+
+    def test_inject_trace_func_threads(self):
+        errors = []
+        def worker(n):
+            try:
+                for i in range(50):
+                    x = None
+                    frame = sys._getframe()
+                    frameutils.inject_trace_func(frame,
+                        lambda f: f.f_locals.update({"x": (n,i)}))
+                    self.assertEqual(x,(n,i))
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=worker,args=(n,)) for n in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors,[])
+        self.assertEqual(frameutils._thread_state.num_frames,0)
+
+    def test_index_with_blocks(self):
+        def f():
+            with a as b:
+                with c:
+                    x = 1
+            with d:
+                return 2
+        (bc,blocks) = frameutils.index_with_blocks(f.__code__)
+        self.assertTrue(frameutils.index_with_blocks(f.__code__)[1] is blocks)
+        self.assertEqual(len(blocks),3)
+        (outer,inner,last) = [blocks[k] for k in sorted(blocks)]
+        self.assertEqual([i.name for i in bc[outer.as_clause]],["STORE_FAST"])
+        self.assertEqual([i.name for i in bc[last.body]],
+                          ["LOAD_CONST","RETURN_VALUE"])
+        self.assertTrue(outer.body.start < inner.body.start)
+        self.assertTrue(inner.teardown.stop <= outer.body.stop)
+
+    @unittest.skipUnless(frameutils.use_monitoring,"needs sys.monitoring")
+    def test_inject_trace_func_monitoring(self):
+        orig_trace = sys.gettrace()
+        traces = []
+        frame = sys._getframe()
+        frameutils.inject_trace_func(frame,lambda f: traces.append(sys.gettrace()))
+        self.assertEqual(traces,[orig_trace])
+        self.assertFalse(frame.f_code in frameutils._monitored_codes)
+
+    def test_inject_trace_func_stale_locals(self):
+        x = 1
+        frame = sys._getframe()
+        frame.f_locals
+        x = 5
+        frameutils.inject_trace_func(frame,lambda f: None)
+        self.assertEqual(x,5)
+        frameutils.inject_trace_func(frame,lambda f: f.f_locals.update({"x": 6}))
+        self.assertEqual(x,6)
+
+
+class TestImportHook(unittest.TestCase):
+
+    def _rewrite(self,source):
+        tree = ast.parse(textwrap.dedent(source))
+        tree = withhacks.importhook.rewrite_module(tree)
+        return (tree,compile(tree,"<test>","exec"))
+
+    def _run(self,source):
+        (tree,code) = self._rewrite(source)
+        self.assertFalse(any(isinstance(n,ast.With) for n in ast.walk(tree)))
+        ns = {}
+        exec(code,ns)
+        return ns
+
+    def test_namespace(self):
+        ns = self._run("""
+            from withhacks import namespace, keyspace
+            a = 42
+            with namespace() as ns:
+                a = 2*a
+                def hello():
+                    return "hi " + str(a)
+                b = len([a])
+            d = {"x": 1}
+            with keyspace(d):
+                x += 1
+                y = x + a
+                del x
+        """)
+        self.assertEqual((ns["a"],ns["ns"].a,ns["ns"].b),(42,84,1))
+        self.assertEqual(ns["ns"].hello.__name__,"hello")
+        self.assertEqual(ns["d"],{"y": 44})
+        self.assertFalse("hello" in ns)
+
+    def test_namespace_augassign(self):
+        ns = self._run("""
+            from withhacks import namespace, keyspace
+            lst = [1]
+            with namespace() as ns:
+                lst += [2]
+            d = {}
+            with keyspace(d):
+                lst += [3]
+        """)
+        self.assertEqual(ns["lst"],[1,2,3])
+        self.assertTrue(ns["ns"].lst is ns["lst"])
+        self.assertTrue(ns["d"]["lst"] is ns["lst"])
+
+    def test_except_as(self):
+        ns = self._run("""
+            from withhacks import CaptureLocals
+            with CaptureLocals() as c:
+                try:
+                    1 // 0
+                except ZeroDivisionError as e:
+                    err = type(e).__name__
+        """)
+        self.assertEqual(ns["c"].locals,{"err": "ZeroDivisionError"})
+
+    def test_xargs(self):
+        ns = self._run("""
+            import withhacks
+            def func(*args,**kwds):
+                return (args,kwds)
+            with withhacks.xargs(func,1,c=3) as v:
+                b = 2
+                a = 1
+                b = 5
+            with withhacks.xkwargs(func,1,c=3) as w:
+                c = 4
+        """)
+        self.assertEqual(ns["v"],((1,5,1),{"c": 3}))
+        self.assertEqual(ns["w"],((1,),{"c": 4}))
+
+    def test_capture(self):
+        ns = self._run("""
+            from withhacks import CaptureFunction, CaptureLocals
+            with CaptureFunction(("a","args"),varargs=True,argdefs=(2,)) as f:
+                return (a,args)
+            with CaptureLocals() as c:
+                x = 1
+        """)
+        self.assertEqual(ns["f"].function(),(2,()))
+        self.assertEqual(ns["f"].function(1,2,3),(1,(2,3)))
+        self.assertEqual(ns["f"].function.__name__,"<withhack>")
+        self.assertEqual(ns["c"].locals,{"x": 1})
+
+    def test_unbound_names(self):
+        ns = self._run("""
+            from withhacks import CaptureLocals, xargs, xkwargs
+            def func(*args,**kwds):
+                return (args,kwds)
+            with CaptureLocals() as c:
+                for i in range(0):
+                    pass
+                z = 1
+            def f():
+                with CaptureLocals() as c:
+                    if False:
+                        x = 1
+                    y = 2
+                return c.locals
+            with xargs(func) as v:
+                if False:
+                    a = 1
+                b = 2
+            with xkwargs(func) as w:
+                if False:
+                    a = 1
+                b = 2
+        """)
+        self.assertEqual(ns["c"].locals,{"z": 1})
+        self.assertEqual(ns["f"](),{"y": 2})
+        self.assertEqual(ns["v"],((2,),{}))
+        self.assertEqual(ns["w"],((),{"b": 2}))
+
+    def test_not_rewritten(self):
+        (tree,code) = self._rewrite("""
+            from withhacks import namespace
+            def f():
+                for i in range(3):
+                    with namespace():
+                        break
+            with namespace() as ns1, namespace() as ns2:
+                pass
+        """)
+        self.assertEqual(sum(isinstance(n,ast.With) for n in ast.walk(tree)),2)
+
+    def test_import_hook(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree,tmpdir)
+        os.mkdir(os.path.join(tmpdir,"whtestpkg"))
+        with open(os.path.join(tmpdir,"whtestpkg","__init__.py"),"w") as f:
+            f.write("from withhacks import keyspace\n"
+                    "with keyspace() as d:\n"
+                    "    x = 1\n")
+        sys.path.insert(0,tmpdir)
+        self.addCleanup(sys.path.remove,tmpdir)
+        self.addCleanup(setattr,sys,"dont_write_bytecode",sys.dont_write_bytecode)
+        sys.dont_write_bytecode = False
+        finder = install_import_hook(["whtestpkg"])
+        try:
+            import whtestpkg
+        finally:
+            uninstall_import_hook(finder)
+            del sys.modules["whtestpkg"]
+        self.assertEqual(whtestpkg.d,{"x": 1})
+        self.assertTrue(hasattr(whtestpkg,"_withhacks_rt"))
+        cached = os.listdir(os.path.join(tmpdir,"whtestpkg","__pycache__"))
+        self.assertEqual(len(cached),1)
+        self.assertTrue(".opt-withhacks" in cached[0])
+
+
+class TestDiskCache(unittest.TestCase):
+
+    def tearDown(self):
+        withhacks.set_cache_dir(None)
+
+    def test_docstrings(self):
+        assert doctest.testmod(withhacks.diskcache)[0] == 0
+
+    def test_cache(self):
+        def f(a):
+            with namespace() as ns:
+                x = a + 1
+            with CaptureFunction(("b",)) as c:
+                return b * 2
+            return (ns.x,c.function(2))
+        cache_dir = tempfile.mkdtemp()
+        withhacks.set_cache_dir(cache_dir)
+        self.assertEqual(f(1),(2,4))
+        self.assertEqual(len(os.listdir(cache_dir)),2)
+        #  Another process would load the code rather than compiling it.
+        withhacks._capture_cache.clear()
+        def fail(*args):
+            raise AssertionError("code should come from the cache")
+        orig = (namespace._compile_namespace,CaptureFunction._compile_function)
+        namespace._compile_namespace = CaptureFunction._compile_function = fail
+        try:
+            self.assertEqual(f(5),(6,4))
+        finally:
+            (namespace._compile_namespace,CaptureFunction._compile_function) = orig
+        self.assertEqual(len(os.listdir(cache_dir)),2)
+
+
+class TestPrecompile(unittest.TestCase):
+
+    def test_precompile(self):
+        def f(a):
+            with withhacks.namespace() as ns:
+                x = a
+            def g():
+                with CaptureLocals() as c:
+                    y = 2
+                return c.locals
+            with open(os.devnull) as fh:
+                pass
+            with keyspace() as ks:
+                z = 3
+            return (ns.x,g(),ks)
+        self.assertEqual(precompile(f),3)
+        (_,blocks) = frameutils.index_with_blocks(f.__code__)
+        for start in blocks:
+            site = withhacks._capture_cache[f.__code__].get(start)
+            if site is not None:
+                self.assertEqual(len(site.compiled),1)
+        orig = namespace._compile_namespace
+        namespace._compile_namespace = None
+        try:
+            self.assertEqual(f(1),(1,{"y": 2},{"z": 3}))
+        finally:
+            namespace._compile_namespace = orig
+        #  Modules and classes are searched too.
+        mod = types.ModuleType("whtestprecompile")
+        exec(textwrap.dedent("""
+            import withhacks
+            class C(object):
+                @staticmethod
+                def f():
+                    with withhacks.CaptureModifiedLocals(assigned_only=True):
+                        x = 1
+            def g(ns):
+                with withhacks.namespace(ns):
+                    with withhacks.xargs(print):
+                        y = 1
+        """),mod.__dict__)
+        self.assertEqual(precompile(mod),3)
+        self.assertEqual(precompile(mod.C),1)
+
+
+class TestStats(unittest.TestCase):
+
+    def tearDown(self):
+        withhacks.disable_stats()
+        withhacks.reset_stats()
+
+    def test_docstrings(self):
+        assert doctest.testmod(withhacks.instrument)[0] == 0
+
+    def test_stats(self):
+        events = []
+        def callback(key,event,duration):
+            events.append((key.hack,event))
+        def f():
+            with CaptureLocals() as c:
+                x = 1
+            with namespace() as ns:
+                y = c.locals["x"] + 1
+            return ns.y
+        withhacks.enable_stats()
+        withhacks.add_stats_callback(callback)
+        try:
+            for _ in range(3):
+                self.assertEqual(f(),2)
+        finally:
+            withhacks.remove_stats_callback(callback)
+            withhacks.disable_stats()
+        self.assertEqual(f(),2)
+        stats = dict((key.hack,(key,s)) for (key,s) in withhacks.stats().items())
+        self.assertEqual(sorted(stats),["CaptureLocals","namespace"])
+        (key,s) = stats["namespace"]
+        self.assertEqual((key.name,key.lineno),("f",f.__code__.co_firstlineno+3))
+        self.assertEqual((s["enters"],s["exits"]),(3,3))
+        self.assertEqual(s["cache_hits"] + s["cache_misses"],6)
+        self.assertTrue(s["cache_hits"] >= 4)
+        self.assertTrue(s["compile_time"] > 0 and s["capture_time"] > 0)
+        self.assertTrue(s["exit_time"] >= s["compile_time"])
+        self.assertTrue(("namespace","compile") in events)
+        self.assertTrue(("CaptureLocals","exit") in events)
+        #  A hack that skips its block spends time tracing.
+        class Skip(WithHack):
+            dont_execute = True
+        withhacks.enable_stats()
+        with Skip():
+            raise RuntimeError("should be skipped")
+        (s,) = [s for (key,s) in withhacks.stats().items() if key.hack == "Skip"]
+        self.assertTrue(s["trace_time"] > 0)
+        self.assertFalse(withhacks.frameutils._trace_hooks is None)
 
 
 class TestMisc(unittest.TestCase):
@@ -142,6 +1029,49 @@ class TestMisc(unittest.TestCase):
         """Test withhacks docstrings."""
         assert doctest.testmod(withhacks)[0] == 0
 
+    def test_benchmarks(self):
+        from withhacks import benchmarks
+        assert doctest.testmod(benchmarks)[0] == 0
+        results = benchmarks.run(["latency","frameutils"],number=1,repeat=1)
+        names = set(r["name"] for r in results)
+        self.assertTrue("CaptureModifiedLocals" in names)
+        self.assertTrue("extract_code" in names)
+        for r in results:
+            self.assertTrue(all(t >= 0 for t in r["timings"].values()))
+
+    def test_import_budget(self):
+        """Importing withhacks mustn't import its heavy dependencies."""
+        script = textwrap.dedent("""
+            import sys
+            before = set(sys.modules)
+            import withhacks
+            heavy = ("bytecode","inspect","dis","copy","threading","ast",
+                     "tempfile","hashlib","importlib.util")
+            print(" ".join(nm for nm in heavy
+                           if nm in sys.modules and nm not in before))
+        """)
+        dirname = os.path.dirname
+        env = dict(os.environ)
+        path = [dirname(dirname(dirname(os.path.abspath(__file__))))]
+        if env.get("PYTHONPATH"):
+            path.append(env["PYTHONPATH"])
+        env["PYTHONPATH"] = os.pathsep.join(path)
+        output = subprocess.check_output([sys.executable,"-c",script],env=env)
+        self.assertEqual(output.decode().strip(),"")
+        #  The deferred modules are picked up as soon as they're needed.
+        with CaptureLocals() as c:
+            x = 1
+        self.assertEqual(c.locals,{"x": 1})
+
+    def test_star_import(self):
+        """A star import mustn't replace modules with lazy stand-ins."""
+        ns = {"inspect": inspect,"copy": None}
+        exec("from withhacks import *",ns)
+        self.assertTrue(ns["inspect"] is inspect)
+        self.assertTrue(ns["copy"] is None)
+        self.assertFalse(any(isinstance(v,withhacks._lazy.LazyModule)
+                             for v in ns.values()))
+
     def test_README(self):
         """Ensure that the README is in sync with the docstring.
 